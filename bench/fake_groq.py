@@ -0,0 +1,229 @@
+"""Local stand-in for the Groq chat-completions API, for offline benchmarks.
+
+Speaks just enough of the OpenAI-compatible /openai/v1/chat/completions
+endpoint for server.py: vision extraction calls get one page object per
+image, whole-paper grading calls get a full GradingResponse, and
+per-question grading calls get a single question grade. Requests with
+stream=true are answered as server-sent chunks. Latency, 429 and 5xx
+rates, and the rate of extraction responses with one corrupted page
+object, are configurable; canned responses can be replaced with a JSON
+file.
+
+    python bench/fake_groq.py --port 9100 --latency 0.4 --failure-rate 0.02
+    GROQ_BASE_URL=http://127.0.0.1:9100 uvicorn server:app
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeGroqConfig:
+    latency: float = 0.3
+    jitter: float = 0.1
+    failure_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 0.5
+    malformed_rate: float = 0.0
+    # Optional overrides: {"extraction": {...page...}, "grading": {...}, "question": {...}}
+    canned: Dict[str, Any] = field(default_factory=dict)
+
+
+def _text_of(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def _question_numbers(text: str):
+    numbers = sorted({int(n) for n in re.findall(r"(?i)question\s*(\d+)", text)})
+    return numbers or [1]
+
+
+def _extraction_response(config: FakeGroqConfig, image_count: int, stats: Dict[str, int]) -> str:
+    page = config.canned.get("extraction") or {
+        "text": "Q{n}) The student's handwritten answer for this page.\nForward voltage is about 2V.",
+        "visual_description": "A hand-drawn I-V curve with labelled axes.",
+        "confidence_text": 0.88,
+        "confidence_visual": 0.8,
+    }
+    pages = []
+    for i in range(image_count):
+        item = dict(page)
+        item["page_number"] = i + 1
+        item["text"] = str(item.get("text", "")).replace("{n}", str(i + 1))
+        pages.append(json.dumps(item))
+    if random.random() < config.malformed_rate:
+        # Balanced braces but not valid JSON, like a model that lost track
+        # of its quoting halfway through one page
+        stats["malformed"] += 1
+        broken = random.randrange(image_count)
+        pages[broken] = pages[broken].replace('", "', '" "', 1)
+    return "[" + ", ".join(pages) + "]"
+
+
+def _question_grade(config: FakeGroqConfig, number: int) -> Dict[str, Any]:
+    grade = dict(config.canned.get("question") or {
+        "points_earned": 3.5,
+        "points_possible": 5,
+        "justification": "Covers the main points with minor omissions.",
+        "feedback": "Label the threshold voltage on the graph.",
+    })
+    grade["question_number"] = number
+    return grade
+
+
+def _grading_response(config: FakeGroqConfig, text: str) -> str:
+    if "grading" in config.canned:
+        return json.dumps(config.canned["grading"])
+    questions = [_question_grade(config, n) for n in _question_numbers(text)]
+    total = sum(q["points_earned"] for q in questions)
+    possible = sum(q["points_possible"] for q in questions)
+    return json.dumps({
+        "total_score": total,
+        "total_possible": possible,
+        "percentage": round(total / possible * 100, 2),
+        "questions": questions,
+    })
+
+
+async def _stream_chunks(completion_id: str, model: str, content: str, usage: Dict[str, int]):
+    # Same framing as Groq: one delta per chunk, usage in the last chunk's
+    # x_groq field, then [DONE]
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra) -> str:
+        return "data: " + json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **extra,
+        }) + "\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    for start in range(0, len(content), 64):
+        yield chunk({"content": content[start:start + 64]})
+        await asyncio.sleep(0)
+    yield chunk({}, "stop", x_groq={"id": completion_id, "usage": usage})
+    yield "data: [DONE]\n\n"
+
+
+def create_app(config: Optional[FakeGroqConfig] = None) -> FastAPI:
+    config = config or FakeGroqConfig()
+    app = FastAPI()
+    app.state.config = config
+    app.state.stats = {"requests": 0, "rate_limited": 0, "failed": 0, "malformed": 0}
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        await asyncio.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": str(config.retry_after)},
+            )
+        if roll < config.rate_limit_rate + config.failure_rate:
+            stats["failed"] += 1
+            return JSONResponse({"error": {"message": "Service unavailable"}}, status_code=503)
+
+        messages = body.get("messages", [])
+        system = _text_of(messages[0]["content"]) if messages else ""
+        user = messages[-1]["content"] if messages else ""
+        image_count = sum(1 for part in user if part.get("type") == "image_url") if isinstance(user, list) else 0
+
+        if image_count:
+            content = _extraction_response(config, image_count, stats)
+        elif "one student answer" in system:
+            content = json.dumps(_question_grade(config, _question_numbers(_text_of(user))[0]))
+        else:
+            content = _grading_response(config, _text_of(user))
+
+        # Images cost a fixed amount each; the text around them is counted
+        # like any other prompt, so prompt changes show up in the usage
+        text_chars = sum(len(_text_of(message["content"])) for message in messages)
+        prompt_tokens = text_chars // 4 + 1500 * image_count
+        completion_tokens = len(content) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        completion_id = f"chatcmpl-fake-{stats['requests']}"
+        if body.get("stream"):
+            return StreamingResponse(
+                _stream_chunks(completion_id, body.get("model", ""), content, usage),
+                media_type="text/event-stream",
+            )
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": usage,
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.3, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="latency standard deviation in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of extraction responses with a broken page")
+    parser.add_argument("--responses", help="JSON file with canned extraction/grading/question responses")
+    args = parser.parse_args()
+
+    canned = {}
+    if args.responses:
+        with open(args.responses) as f:
+            canned = json.load(f)
+
+    import uvicorn
+    uvicorn.run(
+        create_app(FakeGroqConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after=args.retry_after,
+            malformed_rate=args.malformed_rate,
+            canned=canned,
+        )),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
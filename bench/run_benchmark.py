@@ -0,0 +1,364 @@
+"""Offline load benchmark for /process-pdfs and /generate-report.
+
+Starts the fake Groq server from fake_groq.py and the Evalo API under
+uvicorn, both in this process on local ports. It then drives the
+endpoints at each requested concurrency with the demopdf/ samples and
+synthetic multi-page scanned PDFs. For each workload it reports
+p50/p95/p99 latency, throughput in pages/sec, peak RSS of the server
+(including its render pool) and per-stage timings for render, encode,
+extract, grade and report. No Groq quota is used.
+
+    python bench/run_benchmark.py --concurrency 1,4,16 --requests 16 --synthetic-pages 5,20
+    python bench/run_benchmark.py --latency 0.8 --failure-rate 0.05 --json bench_output.json
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+import uvicorn
+
+from fake_groq import FakeGroqConfig, create_app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def synthetic_scanned_pdf(pages: int, seed: int = 0) -> bytes:
+    # Image-only pages with pseudo-handwriting, so every page takes the
+    # vision route like a real scanned answer sheet
+    from PIL import Image, ImageDraw
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    for page in range(pages):
+        image = Image.new("L", (1240, 1754), 250)
+        draw = ImageDraw.Draw(image)
+        draw.text((100, 80), f"Q{page + 1})", fill=20)
+        y = 140
+        while y < 1600:
+            x = 100
+            while x < 1100:
+                word = rng.randint(30, 140)
+                points = [(x + i * 6, y + rng.randint(-6, 6)) for i in range(word // 6)]
+                if len(points) > 1:
+                    draw.line(points, fill=rng.randint(10, 60), width=3)
+                x += word + rng.randint(15, 40)
+            y += rng.randint(45, 70)
+        pdf.drawImage(ImageReader(image), 0, 0, width, height)
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # VmHWM is the peak resident set of a process; the render pool's workers
+    # are separate processes, so they are added on top of this one
+    def vm_hwm(pid) -> float:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0.0
+
+    import resource
+    import server
+    total = vm_hwm("self") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    pool = server._cpu_pool
+    if pool is not None:
+        total += sum(vm_hwm(process.pid) for process in list(pool._processes.values()))
+    return total
+
+
+class StageTimer:
+    # Wraps server functions in place so every call records its duration.
+    # Rendering happens in the pool processes, so its time is taken from the
+    # render_ms each page reports in the response instead.
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def wrap(self, module, name: str, stage: str):
+        func = getattr(module, name)
+        if asyncio.iscoroutinefunction(func):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.samples[stage].append(time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.samples[stage].append(time.perf_counter() - started)
+        setattr(module, name, timed)
+
+    def reset(self):
+        self.samples.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                "count": len(values),
+                "mean_ms": round(statistics.mean(values) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+
+
+async def run_workload(client, timer, name, pdf_bytes, answer_key_bytes, concurrency, requests, grading_mode):
+    timer.reset()
+    latencies, pages, errors = [], 0, 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal pages, errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(
+                "/process-pdfs",
+                files={
+                    "student_pdf": ("student.pdf", pdf_bytes, "application/pdf"),
+                    "answer_key_pdf": ("answer_key.pdf", answer_key_bytes, "application/pdf"),
+                },
+                data={"grading_mode": grading_mode},
+            )
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+                return
+            reports = response.json().get("pages") or []
+            pages += len(reports)
+            for report in reports:
+                if report.get("render_ms") is not None:
+                    timer.samples["render"].append(report["render_ms"] / 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    return {
+        "endpoint": "/process-pdfs",
+        "workload": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "pages_per_s": round(pages / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": timer.summary(),
+    }
+
+
+async def run_report_workload(client, timer, concurrency, requests, questions):
+    timer.reset()
+    grading_results = {
+        "total_score": 3.5 * questions,
+        "total_possible": 5.0 * questions,
+        "percentage": 70.0,
+        "questions": [
+            {
+                "question_number": n + 1,
+                "points_earned": 3.5,
+                "points_possible": 5,
+                "feedback": "Label the threshold voltage on the graph. " * 4,
+                "justification": "Covers the main points with minor omissions.",
+            }
+            for n in range(questions)
+        ],
+    }
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/generate-report", json=grading_results)
+            latency = time.perf_counter() - started
+            latencies.append(latency)
+            timer.samples["report"].append(latency)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    return {
+        "endpoint": "/generate-report",
+        "workload": f"{questions}-questions",
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "reports_per_s": round(requests / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": timer.summary(),
+    }
+
+
+def print_result(result):
+    rate = result.get("pages_per_s", result.get("reports_per_s"))
+    unit = "pages/s" if "pages_per_s" in result else "reports/s"
+    print(
+        f"{result['endpoint']:<17} {result['workload']:<16} c={result['concurrency']:<3} "
+        f"n={result['requests']:<4} err={result['errors']:<3} "
+        f"p50={result['p50_s']:.3f}s p95={result['p95_s']:.3f}s p99={result['p99_s']:.3f}s "
+        f"{rate:.2f} {unit} rss={result['peak_rss_mb']:.0f}MB"
+    )
+    for stage, stats in result["stages"].items():
+        print(f"    {stage:<8} n={stats['count']:<5} mean={stats['mean_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms")
+
+
+async def run(args, cache_dir: str):
+    fake = start_uvicorn(
+        create_app(FakeGroqConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            malformed_rate=args.malformed_rate,
+        )),
+        free_port(),
+    )
+    fake_port = fake.config.port
+
+    # Everything server.py reads at import time has to be set first
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{fake_port}"
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ["EVALO_CACHE_PATH"] = os.path.join(cache_dir, "cache.sqlite3") if args.cache else ""
+    os.environ["EVALO_DATA_PATH"] = os.path.join(cache_dir, "data.sqlite3")
+    os.environ["EVALO_UPLOADS_DIR"] = os.path.join(cache_dir, "uploads")
+    os.environ["EVALO_JOBS_DIR"] = os.path.join(cache_dir, "jobs")
+    if not args.respect_rate_limits:
+        os.environ["EVALO_GROQ_DEFAULT_RPM"] = "1000000"
+        os.environ["EVALO_GROQ_DEFAULT_TPM"] = "1000000000"
+
+    import server
+
+    timer = StageTimer()
+    timer.wrap(server, "build_extraction_messages", "encode")
+    timer.wrap(server, "extract_text_and_visuals_async", "extract")
+    timer.wrap(server, "grade_student_answers_async", "grade")
+    timer.wrap(server, "grade_question_async", "grade")
+
+    api = start_uvicorn(server.app, free_port())
+    api_port = api.config.port
+
+    with open(os.path.join(ROOT, "demopdf", "answer_key.pdf"), "rb") as f:
+        answer_key_bytes = f.read()
+    workloads = []
+    with open(os.path.join(ROOT, "demopdf", "test.pdf"), "rb") as f:
+        workloads.append(("demopdf/test.pdf", f.read()))
+    for pages in args.synthetic_pages:
+        workloads.append((f"synthetic-{pages}p", synthetic_scanned_pdf(pages)))
+
+    results = []
+    timeout = httpx.Timeout(600.0)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", timeout=timeout) as client:
+        # One untimed request warms the render pool and connection pool
+        await run_workload(client, timer, "warmup", workloads[0][1], answer_key_bytes, 1, 1, args.grading_mode)
+        for name, pdf_bytes in workloads:
+            for concurrency in args.concurrency:
+                result = await run_workload(
+                    client, timer, name, pdf_bytes, answer_key_bytes,
+                    concurrency, max(args.requests, concurrency), args.grading_mode,
+                )
+                print_result(result)
+                results.append(result)
+        for concurrency in args.concurrency:
+            result = await run_report_workload(
+                client, timer, concurrency, max(args.requests, concurrency), args.report_questions
+            )
+            print_result(result)
+            results.append(result)
+
+        fake_stats = httpx.get(f"http://127.0.0.1:{fake_port}/stats").json()
+        print(f"fake groq: {fake_stats}")
+
+    api.should_exit = True
+    fake.should_exit = True
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results, "fake_groq": fake_stats}, f, indent=2)
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=8, help="requests per workload and concurrency level")
+    parser.add_argument("--synthetic-pages", type=int_list, default=[5, 20])
+    parser.add_argument("--report-questions", type=int, default=10)
+    parser.add_argument("--grading-mode", default="per_question", choices=["single", "per_question"])
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="keep the result cache enabled")
+    parser.add_argument("--respect-rate-limits", action="store_true", help="keep the configured Groq RPM/TPM limits")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    # The stores and uploaded PDFs of a run live here and are removed with it
+    with tempfile.TemporaryDirectory(prefix="evalo_bench_", ignore_cleanup_errors=True) as cache_dir:
+        asyncio.run(run(args, cache_dir))
+
+
+if __name__ == "__main__":
+    main()
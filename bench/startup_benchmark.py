@@ -0,0 +1,196 @@
+"""Cold start benchmark for the Evalo API.
+
+Measures, each in fresh interpreters:
+
+- import time of server.py, checked against an import-time budget
+- time from launching uvicorn to the first accepted request
+- latency of the first /generate-report after the server is up, with
+  EVALO_WARM_UP on and off
+
+Exits with status 1 if the median import time is over --budget-ms, so it
+can run in CI next to the load benchmark.
+
+    python bench/startup_benchmark.py --runs 5 --budget-ms 800
+    python bench/startup_benchmark.py --import-breakdown 15
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import server; "
+    "print((time.perf_counter() - started) * 1000)"
+)
+
+SAMPLE_REPORT = {
+    "total_score": 7.0,
+    "total_possible": 10.0,
+    "percentage": 70.0,
+    "questions": [
+        {"question_number": n, "points_earned": 3.5, "points_possible": 5.0, "feedback": "Partially correct."}
+        for n in (1, 2)
+    ],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env(data_dir: str, warm_up: bool) -> Dict[str, str]:
+    # No Groq calls are made, and the stores live in a scratch directory so
+    # an existing database does not skew the timings
+    return dict(
+        os.environ,
+        GROQ_API_KEY=os.environ.get("GROQ_API_KEY", "benchmark"),
+        EVALO_CACHE_PATH="",
+        EVALO_DATA_PATH=os.path.join(data_dir, "evalo_data.sqlite3"),
+        EVALO_JOBS_DIR=os.path.join(data_dir, "jobs"),
+        EVALO_UPLOADS_DIR=os.path.join(data_dir, "uploads"),
+        EVALO_EMBEDDED_WORKER="0",
+        EVALO_WARM_UP="1" if warm_up else "0",
+    )
+
+
+def measure_import(env: Dict[str, str]) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def import_breakdown(env: Dict[str, str], top: int) -> List[Dict]:
+    # Cumulative import time of the slowest modules server.py imports
+    # directly, from python -X importtime. Its output lists a module's
+    # imports before the module, indented two spaces deeper.
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    direct, modules = [], []
+    for line in stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+        if depth == 1:
+            direct.append({"module": fields[2].strip(), "ms": int(fields[1]) / 1000})
+        elif depth == 0:
+            if fields[2].strip() == "server":
+                modules = direct
+            direct = []
+    return sorted(modules, key=lambda module: module["ms"], reverse=True)[:top]
+
+
+def warm_up_finished(client: httpx.Client) -> bool:
+    return any(line.startswith("evalo_warm_up_seconds ") for line in client.get("/metrics").text.splitlines())
+
+
+def measure_cold_start(env: Dict[str, str], first_report: bool, after_warm_up: bool) -> Dict[str, float]:
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    result = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60.0) as client:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with status {process.returncode}")
+                try:
+                    if client.get("/metrics").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.01)
+            result["ready_ms"] = (time.perf_counter() - started) * 1000
+            if after_warm_up:
+                deadline = time.perf_counter() + 120
+                while not warm_up_finished(client):
+                    if time.perf_counter() > deadline:
+                        raise RuntimeError("warm-up did not finish; see the server output")
+                    time.sleep(0.02)
+                result["warm_ms"] = (time.perf_counter() - started) * 1000
+            if first_report:
+                sent = time.perf_counter()
+                response = client.post("/generate-report", json=SAMPLE_REPORT)
+                response.raise_for_status()
+                result["first_report_ms"] = (time.perf_counter() - sent) * 1000
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return result
+
+
+def median(values: List[float]) -> float:
+    return round(statistics.median(values), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--budget-ms", type=float, default=800.0, help="median import time allowed for server.py")
+    parser.add_argument("--import-breakdown", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    parser.add_argument("--skip-report", action="store_true", help="only measure time to the first accepted request")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = server_env(data_dir, warm_up=True)
+        imports = [measure_import(env) for _ in range(args.runs)]
+        results["import_ms"] = {"median": median(imports), "max": round(max(imports), 1), "budget": args.budget_ms}
+        print(f"import server: median {results['import_ms']['median']} ms, max {results['import_ms']['max']} ms "
+              f"(budget {args.budget_ms:.0f} ms)")
+
+        if args.import_breakdown:
+            results["import_breakdown"] = import_breakdown(env, args.import_breakdown)
+            for module in results["import_breakdown"]:
+                print(f"  {module['module']:<32} {module['ms']:8.1f} ms")
+
+        # The first report is sent as soon as the server accepts requests,
+        # and, with warm-up on, also once the warm-up has finished
+        scenarios = (
+            ("warm_up_off", False, False),
+            ("warm_up_on", True, False),
+            ("warm_up_on_settled", True, True),
+        )
+        for label, warm_up, after_warm_up in scenarios:
+            runs = [
+                measure_cold_start(server_env(data_dir, warm_up), not args.skip_report, after_warm_up)
+                for _ in range(args.runs)
+            ]
+            results[label] = {key: median([run[key] for run in runs]) for key in runs[0]}
+            line = f"{label:<20} ready after {results[label]['ready_ms']} ms"
+            if "warm_ms" in results[label]:
+                line += f", warm after {results[label]['warm_ms']} ms"
+            if "first_report_ms" in results[label]:
+                line += f", first report {results[label]['first_report_ms']} ms"
+            print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if results["import_ms"]["median"] > args.budget_ms:
+        print(f"Import time is over the {args.budget_ms:.0f} ms budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,1362 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response, JSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, Tuple
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple, Callable, Awaitable, Union, NamedTuple, BinaryIO
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+import httpx
 import json
 import os
 import tempfile
 import shutil
-from typing import Optional
 import base64
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
-from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import pypdfium2 as pdfium
-import PyPDF2
-from groq import Groq
-from dotenv import load_dotenv
 import io
-from fastapi.responses import StreamingResponse
+import asyncio
+import bisect
+import csv
+import contextvars
+import hashlib
+import importlib
+import random
+import re
+import socket
+import sqlite3
+import time
+import uuid
+import zipfile
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
-import json
-import os
-import tempfile
-from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-import io
-from fastapi.responses import StreamingResponse
+# groq, reportlab, pypdfium2, PyPDF2 and numpy take most of the import time
+# and are only needed once a paper is graded or a report rendered, so they
+# are imported where they are used (see warm_up_imports).
+if TYPE_CHECKING:
+    import numpy as np
+    from groq import AsyncGroq
+    from reportlab.platypus import TableStyle
 
 load_dotenv()
 
-app = FastAPI()
+# Number of vision extraction requests allowed in flight for one paper
+EXTRACTION_CONCURRENCY = int(os.getenv("EVALO_EXTRACTION_CONCURRENCY", "4"))
+# Pages sent per vision call. Groq accepts at most 5 images per request.
+EXTRACTION_BATCH_SIZE = min(5, int(os.getenv("EVALO_EXTRACTION_BATCH_SIZE", "4")))
+# Calls per batch before pages that keep coming back missing or malformed
+# fail the batch; each retry only re-sends those pages
+EXTRACTION_ATTEMPTS = int(os.getenv("EVALO_EXTRACTION_ATTEMPTS", "3"))
+# Processes used for pdfium rendering and PyPDF2 parsing
+CPU_WORKERS = int(os.getenv("EVALO_CPU_WORKERS", str(os.cpu_count() or 1)))
+# Connections kept open to the Groq API, shared by every request
+LLM_MAX_CONNECTIONS = int(os.getenv("EVALO_LLM_MAX_CONNECTIONS", "32"))
+# "per_question" grades every rubric question with its own prompt, in
+# parallel; "single" sends the whole key and transcript in one call
+GRADING_MODE = os.getenv("EVALO_GRADING_MODE", "per_question")
+GRADING_MODES = ("single", "per_question")
+# Attempts per question before a per-question grade is given up on
+QUESTION_GRADING_ATTEMPTS = int(os.getenv("EVALO_QUESTION_GRADING_ATTEMPTS", "3"))
+# Estimated prompt tokens allowed per grading call, for the whole paper and
+# for one question; 0 means no limit. Prompts are never shortened: a paper
+# over the whole-paper budget is graded question by question instead, and a
+# prompt that still does not fit fails with a 422.
+GRADING_TOKEN_BUDGET = int(os.getenv("EVALO_GRADING_TOKEN_BUDGET", "0"))
+QUESTION_GRADING_TOKEN_BUDGET = int(os.getenv("EVALO_QUESTION_GRADING_TOKEN_BUDGET", "0"))
+# Seconds between keep-alive comments on idle progress streams
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("EVALO_STREAM_KEEPALIVE_SECONDS", "15"))
+# Server-wide limits shared by single-paper requests and batch jobs
+MAX_CONCURRENT_RENDERS = int(os.getenv("EVALO_MAX_CONCURRENT_RENDERS", str(CPU_WORKERS)))
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("EVALO_MAX_CONCURRENT_LLM_CALLS", "16"))
+# Reports rendering or waiting to be sent at once in a bulk report download
+REPORTS_IN_FLIGHT = int(os.getenv("EVALO_REPORTS_IN_FLIGHT", str(2 * CPU_WORKERS)))
+# Papers from batch jobs that one worker grades at the same time
+BATCH_WORKERS = int(os.getenv("EVALO_BATCH_WORKERS", "8"))
+# Run a job worker inside the API process. Set to 0 when batch jobs are
+# handled by separate `python worker.py` processes instead.
+EMBEDDED_WORKER = os.getenv("EVALO_EMBEDDED_WORKER", "1") == "1"
+# A worker holds each paper it grades under a lease it keeps renewing; if
+# the worker dies, the paper is picked up again once the lease runs out
+JOB_LEASE_SECONDS = float(os.getenv("EVALO_JOB_LEASE_SECONDS", "120"))
+JOB_POLL_SECONDS = float(os.getenv("EVALO_JOB_POLL_SECONDS", "1.0"))
+# Times a paper may be claimed before it is failed instead of retried
+JOB_MAX_ATTEMPTS = int(os.getenv("EVALO_JOB_MAX_ATTEMPTS", "3"))
+# After startup, import the grading and report libraries in the background
+# and start CPU pool workers, so the first paper does not wait for them.
+# The warm-up waits until the server has been accepting requests for a
+# while and starts only a few pool workers; the rest start on demand.
+WARM_UP = os.getenv("EVALO_WARM_UP", "1") == "1"
+WARM_UP_DELAY_SECONDS = float(os.getenv("EVALO_WARM_UP_DELAY_SECONDS", "1.0"))
+WARM_UP_CPU_WORKERS = int(os.getenv("EVALO_WARM_UP_CPU_WORKERS", "1"))
+
+# Groq retry policy for 429s, 5xx responses and connection failures
+LLM_MAX_RETRIES = int(os.getenv("EVALO_LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("EVALO_LLM_BACKOFF_BASE_SECONDS", "1.0"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("EVALO_LLM_BACKOFF_MAX_SECONDS", "60.0"))
+# Per-model requests/tokens per minute, e.g. {"model-name": {"rpm": 30, "tpm": 30000}}.
+# Models not listed fall back to the default limits.
+GROQ_RATE_LIMITS = json.loads(os.getenv("EVALO_GROQ_RATE_LIMITS", "{}"))
+GROQ_DEFAULT_RPM = int(os.getenv("EVALO_GROQ_DEFAULT_RPM", "30"))
+GROQ_DEFAULT_TPM = int(os.getenv("EVALO_GROQ_DEFAULT_TPM", "30000"))
+# Pages whose embedded text layer passes these checks skip the vision model
+TEXT_LAYER_MIN_CHARS = int(os.getenv("EVALO_TEXT_LAYER_MIN_CHARS", "100"))
+TEXT_LAYER_MIN_DENSITY = float(os.getenv("EVALO_TEXT_LAYER_MIN_DENSITY", "1.0"))  # chars per square inch
+TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv("EVALO_TEXT_LAYER_MAX_IMAGE_COVERAGE", "0.5"))
+
+# Page images sent to the vision model: the render scale is chosen so a page
+# comes out at roughly RENDER_PIXEL_BUDGET pixels, then the image is optionally
+# converted to grayscale, cropped to its inked area and re-encoded as JPEG.
+RENDER_PIXEL_BUDGET = int(os.getenv("EVALO_RENDER_PIXEL_BUDGET", "2000000"))
+RENDER_MIN_SCALE = float(os.getenv("EVALO_RENDER_MIN_SCALE", "1.0"))
+RENDER_MAX_SCALE = float(os.getenv("EVALO_RENDER_MAX_SCALE", "4.0"))
+RENDER_GRAYSCALE = os.getenv("EVALO_RENDER_GRAYSCALE", "1") == "1"
+RENDER_CROP_MARGINS = os.getenv("EVALO_RENDER_CROP_MARGINS", "1") == "1"
+RENDER_CROP_PADDING = int(os.getenv("EVALO_RENDER_CROP_PADDING", "16"))
+JPEG_QUALITY = int(os.getenv("EVALO_JPEG_QUALITY", "80"))
+# Pixels darker than INK_THRESHOLD count as ink; pages with less ink than
+# BLANK_PAGE_INK_RATIO are treated as blank and never sent to the model
+INK_THRESHOLD = int(os.getenv("EVALO_INK_THRESHOLD", "200"))
+BLANK_PAGE_INK_RATIO = float(os.getenv("EVALO_BLANK_PAGE_INK_RATIO", "0.001"))
+
+# Refinement pass: after extraction, up to REFINE_MAX_PAGES vision pages per
+# paper whose confidence is below REFINE_BELOW_CONFIDENCE are rendered again
+# at REFINE_PIXEL_BUDGET and re-extracted with REFINE_MODEL. 0 turns it off.
+REFINE_MAX_PAGES = int(os.getenv("EVALO_REFINE_MAX_PAGES", "0"))
+REFINE_BELOW_CONFIDENCE = float(os.getenv("EVALO_REFINE_BELOW_CONFIDENCE", "0.6"))
+REFINE_PIXEL_BUDGET = int(os.getenv("EVALO_REFINE_PIXEL_BUDGET", str(2 * RENDER_PIXEL_BUDGET)))
+
+# Rough prompt-token cost of one page image, used until the real usage comes back
+IMAGE_TOKEN_ESTIMATE = int(os.getenv("EVALO_IMAGE_TOKEN_ESTIMATE", "1500"))
+
+# On-disk cache for page extractions and grading results
+CACHE_PATH = os.getenv("EVALO_CACHE_PATH", "evalo_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("EVALO_CACHE_MAX_ENTRIES", "20000"))
+CACHE_TTL_SECONDS = float(os.getenv("EVALO_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Persistent application data (compiled answer keys, batch jobs)
+DATA_PATH = os.getenv("EVALO_DATA_PATH", "evalo_data.sqlite3")
+# Student PDFs of batch jobs, kept until their paper has been graded. API
+# and worker processes must all see the same directory.
+JOBS_DIR = os.getenv("EVALO_JOBS_DIR", "evalo_jobs")
+# Uploaded PDFs, stored once per distinct content under their SHA-256 so a
+# resubmitted paper or key is not stored or processed again. Files unused
+# for UPLOAD_TTL_SECONDS are removed.
+UPLOADS_DIR = os.getenv("EVALO_UPLOADS_DIR", "evalo_uploads")
+UPLOAD_TTL_SECONDS = float(os.getenv("EVALO_UPLOAD_TTL_SECONDS", str(7 * 24 * 3600)))
+# Largest PDF accepted, on its own or inside a students zip, and its most pages
+MAX_UPLOAD_BYTES = int(float(os.getenv("EVALO_MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+MAX_PDF_PAGES = int(os.getenv("EVALO_MAX_PDF_PAGES", "200"))
+# Largest students zip accepted by /batch-jobs
+MAX_ZIP_UPLOAD_BYTES = int(float(os.getenv("EVALO_MAX_ZIP_UPLOAD_MB", "1024")) * 1024 * 1024)
+# Largest request bodies, per kind of route: a paper and its answer key
+# plus the form fields, a batch job's zip and PDFs, and JSON bodies such as
+# grading results for reports and analytics
+MAX_REQUEST_BYTES = int(os.getenv("EVALO_MAX_REQUEST_BYTES", str(2 * MAX_UPLOAD_BYTES + 1024 * 1024)))
+MAX_BATCH_REQUEST_BYTES = int(os.getenv("EVALO_MAX_BATCH_REQUEST_BYTES", str(MAX_ZIP_UPLOAD_BYTES + MAX_UPLOAD_BYTES)))
+MAX_JSON_REQUEST_BYTES = int(os.getenv("EVALO_MAX_JSON_REQUEST_BYTES", str(8 * 1024 * 1024)))
+
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+GRADING_MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"
+REFINE_MODEL = os.getenv("EVALO_REFINE_MODEL", GRADING_MODEL)
+
+# USD per million prompt/completion tokens, used for the cost metrics.
+# Override with e.g. {"model-name": {"prompt": 0.11, "completion": 0.34}}.
+GROQ_PRICING = {
+    VISION_MODEL: {"prompt": 0.11, "completion": 0.34},
+    GRADING_MODEL: {"prompt": 0.20, "completion": 0.60},
+    **json.loads(os.getenv("EVALO_GROQ_PRICING", "{}")),
+}
+
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_async_groq_client: Optional["AsyncGroq"] = None
+
+def watch_parent_process(parent_pid: int):
+    # Pool workers only exit when the executor tells them to, so one still
+    # starting up when the server stops, or left behind by a killed server,
+    # would otherwise live on blocked on its task queue
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+    threading.Thread(target=watch, name="watch-parent", daemon=True).start()
+
+def get_cpu_pool() -> ProcessPoolExecutor:
+    global _cpu_pool
+    if _cpu_pool is None:
+        # spawn rather than fork: the server already runs threads by the time
+        # the first PDF arrives, and forking those is not safe
+        _cpu_pool = ProcessPoolExecutor(
+            max_workers=max(1, CPU_WORKERS),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=watch_parent_process,
+            initargs=(os.getpid(),),
+        )
+    return _cpu_pool
+
+def get_async_groq_client() -> "AsyncGroq":
+    global _async_groq_client
+    if _async_groq_client is None:
+        from groq import AsyncGroq
+        _async_groq_client = AsyncGroq(
+            api_key=os.getenv("GROQ_API_KEY"),
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                ),
+                timeout=httpx.Timeout(120.0, connect=10.0),
+            ),
+        )
+    return _async_groq_client
+
+render_slots = asyncio.Semaphore(max(1, MAX_CONCURRENT_RENDERS))
+
+async def run_in_cpu_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_pool(), func, *args)
+
+# Upper bounds, in seconds, of the stage duration histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Upper bounds of the prompt size histogram buckets, in tokens
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+class Metrics:
+    # A minimal Prometheus-style registry. Counters, gauges and histograms
+    # are keyed by metric name and label values and rendered in the text
+    # exposition format. Updates come from the event loop and from worker
+    # threads, so they are done under a lock.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Tuple, float]] = {}
+        self._histograms: Dict[str, Dict[Tuple, List]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self._meta[name] = (kind, help_text)
+        if kind == "histogram":
+            self._histograms.setdefault(name, {})
+            self._buckets[name] = buckets
+        else:
+            self._values.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name]
+            if key not in series:
+                series[key] = [[0] * len(self._buckets[name]), 0.0, 0]
+            buckets, _, _ = series[key]
+            for i, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    buckets[i] += 1
+            series[key][1] += value
+            series[key][2] += 1
+
+    @staticmethod
+    def _labels(key: Tuple, extra: Tuple = ()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    for key, value in sorted(self._values[name].items()):
+                        lines.append(f"{name}{self._labels(key)} {value:g}")
+                    continue
+                for key, (buckets, total, count) in sorted(self._histograms[name].items()):
+                    for bound, bucket_count in zip(self._buckets[name], buckets):
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._labels(key)} {total:g}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("evalo_stage_duration_seconds", "histogram", "Time spent per pipeline stage call.")
+metrics.describe("evalo_stage_in_flight", "gauge", "Pipeline stage calls currently running.")
+metrics.describe("evalo_stage_errors_total", "counter", "Pipeline stage calls that raised.")
+metrics.describe("evalo_llm_queue_seconds", "histogram", "Time Groq calls waited for the scheduler.")
+metrics.describe("evalo_llm_requests_total", "counter", "Groq completions received.")
+metrics.describe("evalo_llm_retries_total", "counter", "Groq calls retried after a transient error.")
+metrics.describe("evalo_llm_tokens_total", "counter", "Tokens reported in the usage of Groq completions.")
+metrics.describe(
+    "evalo_llm_prompt_tokens",
+    "histogram",
+    "Estimated prompt size of each Groq call, by stage, before it is sent.",
+    TOKEN_BUCKETS,
+)
+metrics.describe("evalo_llm_prompt_over_budget_total", "counter", "Grading prompts over their token budget.")
+metrics.describe("evalo_llm_cost_usd_total", "counter", "Estimated Groq cost from token usage and EVALO_GROQ_PRICING.")
+metrics.describe("evalo_llm_active", "gauge", "Groq calls currently admitted by the scheduler.")
+metrics.describe("evalo_llm_queued", "gauge", "Groq calls waiting for the scheduler.")
+metrics.describe("evalo_warm_up_seconds", "gauge", "Time the background warm-up took after startup.")
+metrics.describe("evalo_http_requests_in_flight", "gauge", "HTTP requests currently being handled.")
+metrics.describe("evalo_http_request_duration_seconds", "histogram", "HTTP request latency until the response starts.")
+metrics.describe("evalo_cache_lookups_total", "counter", "Result cache lookups.")
+metrics.describe("evalo_cache_entries", "gauge", "Entries in the result cache.")
+metrics.describe("evalo_uploads_total", "counter", "Uploaded PDFs, by whether an identical file was already stored.")
+metrics.describe("evalo_upload_bytes_total", "counter", "Bytes of uploaded PDFs.")
+
+class RequestTrace:
+    # Per-request breakdown of stage time and token usage. Stage times are
+    # summed over every call, so concurrent calls can add up to more than
+    # the request's wall-clock time.
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self._lock:
+            timing = self.stages.setdefault(stage, {"calls": 0, "total_ms": 0.0})
+            timing["calls"] += 1
+            timing["total_ms"] += seconds * 1000
+
+    def add_usage(self, stage: str, prompt_tokens: int, completion_tokens: int, cost_usd: float):
+        with self._lock:
+            timing = self.stages.setdefault(stage, {"calls": 0, "total_ms": 0.0})
+            timing["prompt_tokens"] = timing.get("prompt_tokens", 0) + prompt_tokens
+            timing["completion_tokens"] = timing.get("completion_tokens", 0) + completion_tokens
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost_usd += cost_usd
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                "stages": {
+                    stage: {
+                        "calls": timing["calls"],
+                        "total_ms": round(timing["total_ms"], 1),
+                        "prompt_tokens": timing.get("prompt_tokens", 0),
+                        "completion_tokens": timing.get("completion_tokens", 0),
+                    }
+                    for stage, timing in self.stages.items()
+                },
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cost_usd": round(self.cost_usd, 6),
+            }
+
+# Trace of the request the current task is serving, if any. Tasks and thread
+# pool calls copy the context, so everything a request starts reports to it.
+current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+@contextmanager
+def track_stage(stage: str, model: str = ""):
+    metrics.inc("evalo_stage_in_flight", stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("evalo_stage_errors_total", stage=stage, model=model)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.inc("evalo_stage_in_flight", -1, stage=stage)
+        metrics.observe("evalo_stage_duration_seconds", elapsed, stage=stage, model=model)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_stage(stage, elapsed)
+
+def record_llm_usage(stage: str, model: str, chat_completion: Any):
+    metrics.inc("evalo_llm_requests_total", stage=stage, model=model)
+    usage = getattr(chat_completion, "usage", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    pricing = GROQ_PRICING.get(model, {})
+    cost_usd = (
+        prompt_tokens * pricing.get("prompt", 0.0)
+        + completion_tokens * pricing.get("completion", 0.0)
+    ) / 1_000_000
+    metrics.inc("evalo_llm_tokens_total", prompt_tokens, stage=stage, model=model, kind="prompt")
+    metrics.inc("evalo_llm_tokens_total", completion_tokens, stage=stage, model=model, kind="completion")
+    metrics.inc("evalo_llm_cost_usd_total", cost_usd, stage=stage, model=model)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_usage(stage, prompt_tokens, completion_tokens, cost_usd)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+# Scheduling priority of the Groq calls made by the current task. Batch jobs
+# set it once in their top-level task and every call they make inherits it.
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=PRIORITY_INTERACTIVE
+)
+
+def is_retryable_groq_error(error: Exception) -> bool:
+    from groq import APIConnectionError, APIStatusError
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    # A streamed response can also break mid-body, below the SDK
+    return isinstance(error, (APIConnectionError, httpx.TransportError))
+
+def groq_retry_delay(attempt: int, error: Exception) -> float:
+    # Honor the server's retry-after when it sends one, otherwise use
+    # full-jitter exponential backoff
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS) + random.uniform(0, 0.5)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def estimate_prompt_tokens(messages: List[Dict]) -> int:
+    tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+def account_prompt(stage: str, model: str, messages: List[Dict]) -> int:
+    # Records the estimated size of a prompt about to be sent and returns
+    # it, for the scheduler's TPM reservation. The actual prompt tokens are
+    # recorded from the response's usage by record_llm_usage.
+    tokens = estimate_prompt_tokens(messages)
+    metrics.observe("evalo_llm_prompt_tokens", tokens, stage=stage, model=model)
+    return tokens
+
+def compact_text(text: str) -> str:
+    # Trailing whitespace costs tokens and carries nothing; spacing and line
+    # breaks within the text are kept, as the extraction prompt asks
+    return "\n".join(line.rstrip() for line in text.splitlines()).strip()
+
+def prompt_over_budget(stage: str, messages: List[Dict], budget: int) -> Optional[int]:
+    # The prompt's estimated size when it is over budget, else None
+    tokens = estimate_prompt_tokens(messages)
+    if budget <= 0 or tokens <= budget:
+        return None
+    metrics.inc("evalo_llm_prompt_over_budget_total", stage=stage)
+    return tokens
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = max(1.0, float(per_minute))
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        # A request larger than the whole bucket is allowed through once the
+        # bucket is full, otherwise it could never be sent
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < amount:
+            wait = max(wait, (amount - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, amount: float):
+        self.tokens -= amount
+
+class GroqScheduler:
+    # Admission control for every async Groq call. Each model has an RPM and
+    # a TPM token bucket; waiting calls are granted in priority order (per
+    # model, so one throttled model does not hold up the other), and
+    # retryable failures are retried with backoff. A 429 pauses the model's
+    # buckets for everyone, not just for the call that hit it.
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.active = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._waiters: List[Tuple[int, int, str, int, asyncio.Future]] = []
+        self._sequence = 0
+        self._changed = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _model_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            limits = GROQ_RATE_LIMITS.get(model, {})
+            self._buckets[model] = (
+                TokenBucket(limits.get("rpm", GROQ_DEFAULT_RPM)),
+                TokenBucket(limits.get("tpm", GROQ_DEFAULT_TPM)),
+            )
+        return self._buckets[model]
+
+    async def _dispatch(self):
+        while True:
+            self._changed.clear()
+            next_check = None
+            now = time.monotonic()
+            blocked_models = set()
+            for waiter in list(self._waiters):
+                _, _, model, tokens, future = waiter
+                if future.done():
+                    self._waiters.remove(waiter)
+                    continue
+                if self.active >= self.max_concurrency:
+                    break
+                if model in blocked_models:
+                    continue
+                requests_bucket, tokens_bucket = self._model_buckets(model)
+                wait = max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(tokens, now))
+                if wait > 0:
+                    blocked_models.add(model)
+                    next_check = wait if next_check is None else min(next_check, wait)
+                    continue
+                requests_bucket.consume(1)
+                tokens_bucket.consume(min(tokens, tokens_bucket.capacity))
+                self._waiters.remove(waiter)
+                self.active += 1
+                future.set_result(None)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=next_check)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, model: str, tokens: int, priority: int):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._changed = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        bisect.insort(self._waiters, (priority, self._sequence, model, tokens, future))
+        self._changed.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._changed.set()
+
+    async def submit(
+        self,
+        model: str,
+        estimated_tokens: int,
+        call: Callable[[], Any],
+        priority: Optional[int] = None,
+    ) -> Any:
+        if priority is None:
+            priority = request_priority.get()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            queued_at = time.perf_counter()
+            await self._acquire(model, estimated_tokens, priority)
+            metrics.observe("evalo_llm_queue_seconds", time.perf_counter() - queued_at, model=model)
+            try:
+                result = await call()
+            except Exception as e:
+                if attempt == LLM_MAX_RETRIES or not is_retryable_groq_error(e):
+                    raise
+                delay = groq_retry_delay(attempt, e)
+                self.retries += 1
+                metrics.inc(
+                    "evalo_llm_retries_total",
+                    model=model,
+                    status=str(getattr(e, "status_code", "connection")),
+                )
+                if getattr(e, "status_code", None) == 429:
+                    self.rate_limited += 1
+                    for bucket in self._model_buckets(model):
+                        bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                self._release()
+
+            # Settle the token bucket against what the call really used
+            usage = getattr(result, "usage", None)
+            if usage is not None and getattr(usage, "total_tokens", None) is not None:
+                self._model_buckets(model)[1].consume(usage.total_tokens - estimated_tokens)
+            return result
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": sum(1 for waiter in self._waiters if not waiter[4].done()),
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+        }
+
+groq_scheduler = GroqScheduler(MAX_CONCURRENT_LLM_CALLS)
+
+class ResultCache:
+    # A small SQLite key/value store for JSON results. Entries older than
+    # ttl_seconds are treated as misses, and once the table grows past
+    # max_entries the least recently used rows are evicted.
+
+    def __init__(self, path: str, table: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed_at)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[1] > self.ttl_seconds:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                conn.commit()
+                self.misses += 1
+                self.evictions += 1
+                return None
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            cursor = conn.execute(
+                f"DELETE FROM {self.table} WHERE created_at < ? OR key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (now - self.ttl_seconds, self.max_entries),
+            )
+            self.evictions += cursor.rowcount
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        entries = 0
+        if self.enabled:
+            with self._lock:
+                entries = self._connection().execute(
+                    f"SELECT COUNT(*) FROM {self.table}"
+                ).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class AnswerKeyStore:
+    # Compiled answer keys, stored once and referenced by ID from every
+    # grading request for the class
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_keys ("
+                "answer_key_id TEXT PRIMARY KEY, filename TEXT NOT NULL, "
+                "text TEXT NOT NULL, rubric TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def save(self, answer_key_id: str, filename: str, text: str, rubric: List[Dict]):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO answer_keys "
+                "(answer_key_id, filename, text, rubric, created_at) VALUES (?, ?, ?, ?, ?)",
+                (answer_key_id, filename, text, json.dumps(rubric), time.time()),
+            )
+            conn.commit()
+
+    def load(self, answer_key_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT filename, text, rubric FROM answer_keys WHERE answer_key_id = ?",
+                (answer_key_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "answer_key_id": answer_key_id,
+            "filename": row[0],
+            "text": row[1],
+            "rubric": json.loads(row[2]),
+        }
+
+    def delete(self, answer_key_id: str) -> bool:
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "DELETE FROM answer_keys WHERE answer_key_id = ?", (answer_key_id,)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+answer_key_store = AnswerKeyStore(DATA_PATH)
+
+class UploadTooLarge(Exception):
+    pass
+
+def copy_limited(source: BinaryIO, target: BinaryIO, max_bytes: int, digest=None) -> int:
+    # Copies in chunks, hashing on the way if a digest is given, and stops
+    # as soon as more than max_bytes have been read
+    size = 0
+    for chunk in iter(lambda: source.read(1024 * 1024), b""):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge()
+        if digest is not None:
+            digest.update(chunk)
+        target.write(chunk)
+    return size
+
+class UploadStore:
+    # Content-addressed PDF storage: each distinct file is written once to
+    # directory/<first two hex digits>/<sha256>.pdf, and an index row keeps
+    # its size and page count so a repeat upload needs neither. Files are
+    # never modified once stored, which lets batch jobs hard-link them.
+
+    def __init__(self, path: str, directory: str, ttl_seconds: float):
+        self.path = path
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "document_id TEXT PRIMARY KEY, size INTEGER NOT NULL, page_count INTEGER, "
+                "created_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def blob_path(self, document_id: str) -> str:
+        return os.path.join(self.directory, document_id[:2], document_id + ".pdf")
+
+    def put(self, source: BinaryIO, max_bytes: int) -> Dict[str, Any]:
+        # Streams source into a temporary file next to the blobs while
+        # hashing it, then moves it into place unless that content is
+        # already stored. Raises UploadTooLarge past max_bytes.
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as target:
+                size = copy_limited(source, target, max_bytes, digest)
+            document_id = digest.hexdigest()
+            path = self.blob_path(document_id)
+            reused = os.path.exists(path)
+            if not reused:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO uploads (document_id, size, page_count, created_at, used_at) "
+                "VALUES (?, ?, NULL, ?, ?) ON CONFLICT (document_id) DO UPDATE SET used_at = excluded.used_at",
+                (document_id, size, now, now),
+            )
+            conn.commit()
+            row = conn.execute(
+                "SELECT page_count FROM uploads WHERE document_id = ?", (document_id,)
+            ).fetchone()
+        return {
+            "document_id": document_id,
+            "path": path,
+            "size": size,
+            "page_count": row[0],
+            "reused": reused,
+        }
+
+    def set_page_count(self, document_id: str, page_count: int):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "UPDATE uploads SET page_count = ? WHERE document_id = ?", (page_count, document_id)
+            )
+            conn.commit()
+
+    def discard(self, document_id: str):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM uploads WHERE document_id = ?", (document_id,))
+            conn.commit()
+        try:
+            os.remove(self.blob_path(document_id))
+        except OSError:
+            pass
+
+    def prune(self) -> int:
+        # Removes files not uploaded again within the TTL, and temporary
+        # files left by an interrupted upload
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            conn = self._connection()
+            expired = [row[0] for row in conn.execute(
+                "SELECT document_id FROM uploads WHERE used_at < ?", (cutoff,)
+            )]
+            conn.executemany("DELETE FROM uploads WHERE document_id = ?", [(d,) for d in expired])
+            conn.commit()
+        for document_id in expired:
+            try:
+                os.remove(self.blob_path(document_id))
+            except OSError:
+                pass
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith(".part") and os.path.getmtime(path) < time.time() - 3600:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        return len(expired)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+upload_store = UploadStore(DATA_PATH, UPLOADS_DIR, UPLOAD_TTL_SECONDS)
+
+# Paper statuses a worker may still pick up
+ACTIVE_PAPER_STATUSES = ("queued", "extracting", "grading")
+
+class JobStore:
+    # Durable state of batch jobs: one row per job, one per student paper,
+    # and one per extracted page and graded question, so a paper whose
+    # worker stopped can be resumed without paying for those calls again.
+    # Several processes may share the database; papers are handed out with
+    # BEGIN IMMEDIATE so no two workers claim the same one.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Autocommit; transactions are opened explicitly where needed
+            self._conn = sqlite3.connect(
+                self.path, check_same_thread=False, timeout=30, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, answer_key_id TEXT NOT NULL, "
+                "grading_mode TEXT NOT NULL, work_dir TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_papers ("
+                "job_id TEXT NOT NULL, student_id INTEGER NOT NULL, filename TEXT NOT NULL, "
+                "pdf_path TEXT NOT NULL, status TEXT NOT NULL, page_count INTEGER, "
+                "error TEXT, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+                "lease_owner TEXT, lease_expires REAL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (job_id, student_id))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS job_papers_status ON job_papers (status, lease_expires)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_pages ("
+                "job_id TEXT NOT NULL, student_id INTEGER NOT NULL, page_number INTEGER NOT NULL, "
+                "data TEXT NOT NULL, PRIMARY KEY (job_id, student_id, page_number))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_questions ("
+                "job_id TEXT NOT NULL, student_id INTEGER NOT NULL, question_number INTEGER NOT NULL, "
+                "data TEXT NOT NULL, PRIMARY KEY (job_id, student_id, question_number))"
+            )
+        return self._conn
+
+    def create_job(
+        self,
+        job_id: str,
+        answer_key_id: str,
+        grading_mode: str,
+        work_dir: str,
+        papers: List[Tuple[str, str]],
+    ):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT INTO jobs (job_id, answer_key_id, grading_mode, work_dir, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (job_id, answer_key_id, grading_mode, work_dir, now),
+                )
+                conn.executemany(
+                    "INSERT INTO job_papers (job_id, student_id, filename, pdf_path, status, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?)",
+                    [
+                        (job_id, student_id, filename, pdf_path, now)
+                        for student_id, (filename, pdf_path) in enumerate(papers)
+                    ],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def fail_abandoned(self) -> List[Dict[str, Any]]:
+        # Fails papers whose lease expired after JOB_MAX_ATTEMPTS claims, and
+        # returns each one's job_id, pdf_path and whether its job is now done,
+        # for the caller to remove their files
+        now = time.time()
+        placeholders = ",".join("?" * len(ACTIVE_PAPER_STATUSES))
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    f"SELECT job_id, student_id, pdf_path FROM job_papers WHERE status IN ({placeholders}) "
+                    "AND lease_expires < ? AND attempts >= ?",
+                    (*ACTIVE_PAPER_STATUSES, now, JOB_MAX_ATTEMPTS),
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE job_papers SET status = 'failed', lease_owner = NULL, lease_expires = NULL, "
+                    "updated_at = ?, error = 'Abandoned after ' || attempts || ' attempts' "
+                    "WHERE job_id = ? AND student_id = ?",
+                    [(now, row[0], row[1]) for row in rows],
+                )
+                for table in ("job_pages", "job_questions"):
+                    conn.executemany(
+                        f"DELETE FROM {table} WHERE job_id = ? AND student_id = ?",
+                        [(row[0], row[1]) for row in rows],
+                    )
+                remaining = {
+                    job_id: conn.execute(
+                        f"SELECT COUNT(*) FROM job_papers WHERE job_id = ? AND status IN ({placeholders})",
+                        (job_id, *ACTIVE_PAPER_STATUSES),
+                    ).fetchone()[0]
+                    for job_id in {row[0] for row in rows}
+                }
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [{"job_id": row[0], "pdf_path": row[2], "job_done": remaining[row[0]] == 0} for row in rows]
+
+    def claim(self, worker_id: str, limit: int, lease_seconds: float) -> List[Dict[str, Any]]:
+        # Hands out up to `limit` papers that are queued or whose lease has
+        # expired, oldest job first. Papers that have already been claimed
+        # JOB_MAX_ATTEMPTS times are left for fail_abandoned.
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                placeholders = ",".join("?" * len(ACTIVE_PAPER_STATUSES))
+                rows = conn.execute(
+                    "SELECT p.job_id, p.student_id, p.pdf_path, p.status, j.answer_key_id, j.grading_mode "
+                    "FROM job_papers p JOIN jobs j ON j.job_id = p.job_id "
+                    f"WHERE p.status IN ({placeholders}) "
+                    "AND (p.lease_expires IS NULL OR (p.lease_expires < ? AND p.attempts < ?)) "
+                    "ORDER BY j.created_at, p.student_id LIMIT ?",
+                    (*ACTIVE_PAPER_STATUSES, now, JOB_MAX_ATTEMPTS, limit),
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE job_papers SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                    "status = CASE status WHEN 'queued' THEN 'extracting' ELSE status END, "
+                    "updated_at = ? WHERE job_id = ? AND student_id = ?",
+                    [(worker_id, now + lease_seconds, now, row[0], row[1]) for row in rows],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [
+            {
+                "job_id": row[0],
+                "student_id": row[1],
+                "pdf_path": row[2],
+                "answer_key_id": row[4],
+                "grading_mode": row[5],
+            }
+            for row in rows
+        ]
+
+    def renew(self, worker_id: str, lease_seconds: float):
+        now = time.time()
+        with self._lock:
+            self._connection().execute(
+                "UPDATE job_papers SET lease_expires = ? WHERE lease_owner = ? AND status IN (?, ?, ?)",
+                (now + lease_seconds, worker_id, *ACTIVE_PAPER_STATUSES),
+            )
+
+    def release(self, worker_id: str):
+        # Makes a stopping worker's papers claimable right away. The claim
+        # they cost is given back, since nothing went wrong with the paper.
+        with self._lock:
+            self._connection().execute(
+                "UPDATE job_papers SET lease_owner = NULL, lease_expires = NULL, "
+                "attempts = MAX(attempts - 1, 0) WHERE lease_owner = ? AND status IN (?, ?, ?)",
+                (worker_id, *ACTIVE_PAPER_STATUSES),
+            )
+
+    def load_progress(self, job_id: str, student_id: int) -> Tuple[Dict[int, List[Dict]], Dict[int, Dict]]:
+        with self._lock:
+            conn = self._connection()
+            pages = conn.execute(
+                "SELECT page_number, data FROM job_pages WHERE job_id = ? AND student_id = ?",
+                (job_id, student_id),
+            ).fetchall()
+            questions = conn.execute(
+                "SELECT question_number, data FROM job_questions WHERE job_id = ? AND student_id = ?",
+                (job_id, student_id),
+            ).fetchall()
+        return (
+            {number: json.loads(data) for number, data in pages},
+            {number: json.loads(data) for number, data in questions},
+        )
+
+    def save_pages(self, job_id: str, student_id: int, pages: List[Dict], page_count: int):
+        by_page: Dict[int, List[Dict]] = {}
+        for page in pages:
+            by_page.setdefault(page.get("page_number", 0), []).append(page)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO job_pages (job_id, student_id, page_number, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(job_id, student_id, number, json.dumps(items)) for number, items in by_page.items()],
+                )
+                conn.execute(
+                    "UPDATE job_papers SET page_count = ?, updated_at = ? WHERE job_id = ? AND student_id = ?",
+                    (page_count, time.time(), job_id, student_id),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def save_question(self, job_id: str, student_id: int, question: Dict):
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO job_questions (job_id, student_id, question_number, data) "
+                "VALUES (?, ?, ?, ?)",
+                (job_id, student_id, question["question_number"], json.dumps(question)),
+            )
+
+    def set_status(self, job_id: str, student_id: int, status: str):
+        with self._lock:
+            self._connection().execute(
+                "UPDATE job_papers SET status = ?, updated_at = ? WHERE job_id = ? AND student_id = ?",
+                (status, time.time(), job_id, student_id),
+            )
+
+    def finish(
+        self,
+        job_id: str,
+        student_id: int,
+        worker_id: str,
+        result: Optional[Dict] = None,
+        error: Optional[str] = None,
+    ) -> Tuple[bool, bool]:
+        # Records the paper's outcome and returns whether this worker still
+        # held the paper's lease, and whether every paper of the job is now
+        # done. Page and question progress is dropped, since the result now
+        # holds everything.
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute(
+                    "UPDATE job_papers SET status = ?, result = ?, error = ?, lease_owner = NULL, "
+                    "lease_expires = NULL, updated_at = ? WHERE job_id = ? AND student_id = ? AND lease_owner = ?",
+                    (
+                        "failed" if error is not None else "completed",
+                        json.dumps(result) if result is not None else None,
+                        error,
+                        time.time(),
+                        job_id,
+                        student_id,
+                        worker_id,
+                    ),
+                )
+                # A worker whose lease ran out may not overwrite, or delete the
+                # progress of, the worker that took the paper over
+                if cursor.rowcount:
+                    for table in ("job_pages", "job_questions"):
+                        conn.execute(
+                            f"DELETE FROM {table} WHERE job_id = ? AND student_id = ?", (job_id, student_id)
+                        )
+                remaining = conn.execute(
+                    "SELECT COUNT(*) FROM job_papers WHERE job_id = ? AND status IN (?, ?, ?)",
+                    (job_id, *ACTIVE_PAPER_STATUSES),
+                ).fetchone()[0]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount > 0, remaining == 0
+
+    def work_dir(self, job_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT work_dir FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            conn = self._connection()
+            job = conn.execute(
+                "SELECT answer_key_id, grading_mode, created_at FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            papers = conn.execute(
+                "SELECT p.student_id, p.filename, p.status, p.page_count, p.error, p.result, "
+                "(SELECT COUNT(*) FROM job_pages g WHERE g.job_id = p.job_id AND g.student_id = p.student_id) "
+                "FROM job_papers p WHERE p.job_id = ? ORDER BY p.student_id",
+                (job_id,),
+            ).fetchall()
+        return {
+            "job_id": job_id,
+            "answer_key_id": job[0],
+            "grading_mode": job[1],
+            "created_at": job[2],
+            "students": [
+                {
+                    "student_id": row[0],
+                    "filename": row[1],
+                    "status": row[2],
+                    "page_count": row[3],
+                    "error": row[4],
+                    "result": json.loads(row[5]) if row[5] is not None else None,
+                    # A finished paper's pages are no longer stored
+                    "pages_done": row[6] if row[2] in ACTIVE_PAPER_STATUSES else row[3] or 0,
+                }
+                for row in papers
+            ],
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+job_store = JobStore(DATA_PATH)
+
+extraction_cache = ResultCache(CACHE_PATH, "page_extractions", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+grading_cache = ResultCache(CACHE_PATH, "grading_results", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+# Whole-document extractions keyed by the uploaded file's SHA-256, so a
+# resubmitted paper is neither rendered nor sent to the vision model again
+document_cache = ResultCache(CACHE_PATH, "document_extractions", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Imported by warm_up_imports; everything else heavy is imported on first use
+WARM_UP_MODULES = (
+    "groq",
+    "pypdfium2",
+    "pypdfium2.raw",
+    "PyPDF2",
+    "reportlab.platypus",
+    "numpy",
+)
+
+def warm_up_imports():
+    for name in WARM_UP_MODULES:
+        importlib.import_module(name)
+    report_styles()
+    report_table_style()
+
+async def warm_up():
+    # Runs as a task from the lifespan, which is before uvicorn starts
+    # listening, so it first waits: importing and spawning interpreters
+    # competes with the server for the CPU and the GIL.
+    await asyncio.sleep(WARM_UP_DELAY_SECONDS)
+    started = time.perf_counter()
+    pool = get_cpu_pool()
+
+    async def warm_pool_worker():
+        # Each pool worker is a spawned interpreter that imports this
+        # module. submit() starts the process on the calling thread, so it
+        # is called from a thread rather than the event loop.
+        future = await run_in_threadpool(pool.submit, warm_up_imports)
+        await asyncio.wrap_future(future)
+
+    try:
+        # One worker first, so an early request gets a warm worker as soon
+        # as possible. The executor only starts a process when none is
+        # idle, so the later submissions start the others.
+        await warm_pool_worker()
+        await asyncio.gather(
+            run_in_threadpool(warm_up_imports),
+            *(warm_pool_worker() for _ in range(min(WARM_UP_CPU_WORKERS, CPU_WORKERS) - 1)),
+        )
+    except Exception as e:
+        # Only the first requests get slower; they import what they need
+        print(f"Warning: warm-up failed: {e}")
+        return
+    metrics.set("evalo_warm_up_seconds", time.perf_counter() - started)
+
+async def prune_uploads():
+    # Stored uploads are pruned at startup and then hourly
+    while True:
+        await run_in_threadpool(upload_store.prune)
+        await asyncio.sleep(3600)
+
+async def close_shared_resources():
+    global _cpu_pool, _async_groq_client
+    await groq_scheduler.close()
+    if _async_groq_client is not None:
+        await _async_groq_client.close()
+        _async_groq_client = None
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=False, cancel_futures=True)
+        _cpu_pool = None
+    extraction_cache.close()
+    grading_cache.close()
+    document_cache.close()
+    answer_key_store.close()
+    upload_store.close()
+    job_store.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_worker
+    worker_task = None
+    warm_up_task = asyncio.create_task(warm_up()) if WARM_UP else None
+    prune_task = asyncio.create_task(prune_uploads())
+    if EMBEDDED_WORKER:
+        job_worker = JobWorker(job_store, BATCH_WORKERS)
+        worker_task = asyncio.create_task(job_worker.run())
+    yield
+    for task in (warm_up_task, prune_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if worker_task is not None:
+        worker_task.cancel()
+        await asyncio.gather(worker_task, return_exceptions=True)
+    await close_shared_resources()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS to allow requests from React frontend
 app.add_middleware(
@@ -51,11 +1367,132 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class RequestSizeLimit:
+    # Starlette spools a multipart body to disk, and reads a JSON body into
+    # memory, before the endpoint runs, so the body is counted as it arrives
+    # and refused once it passes the route's limit, whether or not a
+    # Content-Length was sent. A declared length over the limit is refused
+    # before any of it is read. Paths not in `limits` get `default`.
+
+    def __init__(self, app, limits: Dict[str, int], default: int):
+        self.app = app
+        self.limits = limits
+        self.default = default
+
+    def too_large(self, max_bytes: int) -> HTTPException:
+        return HTTPException(
+            status_code=413, detail=f"Request body is larger than the {max_bytes} byte limit"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        max_bytes = self.limits.get(scope["path"].rstrip("/") or "/", self.default)
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            await JSONResponse(status_code=413, content={"detail": self.too_large(max_bytes).detail})(
+                scope, receive, send
+            )
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    # FastAPI turns this into the response when it is raised
+                    # while the body is parsed
+                    raise self.too_large(max_bytes)
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            if e.status_code != 413 or response_started:
+                raise
+            await JSONResponse(status_code=413, content={"detail": e.detail})(scope, receive, send)
+
+app.add_middleware(
+    RequestSizeLimit,
+    limits={
+        "/process-pdfs": MAX_REQUEST_BYTES,
+        "/process-pdfs/stream": MAX_REQUEST_BYTES,
+        "/answer-keys": MAX_REQUEST_BYTES,
+        "/batch-jobs": MAX_BATCH_REQUEST_BYTES,
+    },
+    default=MAX_JSON_REQUEST_BYTES,
+)
+
+@app.middleware("http")
+async def track_http_requests(request: Request, call_next):
+    metrics.inc("evalo_http_requests_in_flight")
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.inc("evalo_http_requests_in_flight", -1)
+        # The route template rather than the raw path, so IDs in the URL do
+        # not create a series each
+        route = request.scope.get("route")
+        metrics.observe(
+            "evalo_http_request_duration_seconds",
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status),
+        )
+
+class PageReport(BaseModel):
+    page_number: int
+    route: str
+    chars: int = 0
+    text_density: float = 0.0
+    image_coverage: float = 0.0
+    confidence: Optional[float] = None
+    scale: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    raw_bytes: Optional[int] = None
+    payload_bytes: Optional[int] = None
+    render_ms: Optional[float] = None
+    extract_ms: Optional[float] = None
+    refined: bool = False
+
+class StageTiming(BaseModel):
+    calls: int
+    total_ms: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+class RequestTimings(BaseModel):
+    total_ms: float
+    stages: Dict[str, StageTiming]
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+
 class GradingResponse(BaseModel):
     total_score: float
     total_possible: float
     percentage: float
     questions: List[Dict[str, Any]]
+    pages: Optional[List[PageReport]] = None
+    timings: Optional[RequestTimings] = None
 
 class PageExtraction(BaseModel):
     page_number: int
@@ -77,113 +1514,385 @@ class GradingResults(BaseModel):
     percentage: float
     questions: List[Question]
 
+class StudentReport(GradingResults):
+    student_name: Optional[str] = None
 
-def save_pdf_images(pdf_path, output_folder, scale=4):
-    os.makedirs(output_folder, exist_ok=True)
-    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-    pdf = pdfium.PdfDocument(pdf_path)
-    for i in range(len(pdf)):
-        page = pdf[i]
-        image = page.render(scale=scale).to_pil()
-        output_path = os.path.join(output_folder, f"{pdf_name}_{i:03d}.jpg")
-        image.save(output_path)
+class BulkReportRequest(BaseModel):
+    reports: List[StudentReport] = []
+    batch_job_id: Optional[str] = None
 
-def list_image_paths(folder_path, limit=None):
-    try:
-        all_files = os.listdir(folder_path)
-        image_files = [f for f in all_files if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-        if limit is not None:
-            image_files = image_files[:limit]
-        image_paths = [os.path.join(folder_path, image) for image in image_files]
-        return image_paths
-    except Exception as e:
-        return []
+class AnalyticsRequest(BaseModel):
+    results: List[StudentReport] = []
+    batch_job_id: Optional[str] = None
 
-def delete_first_n_images(folder_path, n):
-    try:
-        all_files = os.listdir(folder_path)
-        image_files = [f for f in all_files if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-        image_files = sorted(image_files)[:n]
-        for image in image_files:
-            os.remove(os.path.join(folder_path, image))
-    except Exception as e:
-        pass
+class QuestionAnalytics(BaseModel):
+    question_number: int
+    points_possible: float
+    answered: int
+    mean: float
+    std: float
+    median: float
+    min: float
+    max: float
+    # Mean score as a fraction of the points possible (classical p-value)
+    difficulty: float
+    full_marks_rate: float
+    zero_rate: float
+    # Correlation of the question's score with the rest of the paper
+    item_total_correlation: Optional[float] = None
+    # Mean fraction scored by the top 27% of the class minus the bottom 27%
+    discrimination_index: Optional[float] = None
 
-def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+class ScoreDistribution(BaseModel):
+    mean: float
+    std: float
+    min: float
+    max: float
+    quartiles: List[float]
+    histogram_edges: List[float]
+    histogram_counts: List[int]
+    bands: Dict[str, int]
 
-def extract_text_and_visuals(
-    image_paths: List[str], 
-    prompt: str, 
-    num_images: Optional[int] = None,
-    model: str = "meta-llama/llama-4-scout-17b-16e-instruct"
-) -> List[Dict]:
-  
-    if num_images:
-        image_paths = image_paths[:num_images]
+class StudentOutlier(BaseModel):
+    student_index: int
+    student_name: Optional[str] = None
+    percentage: float
+    robust_z: float
+
+class ClassAnalytics(BaseModel):
+    students: int
+    questions: int
+    # Cronbach's alpha over the question scores
+    reliability: Optional[float] = None
+    percentage: ScoreDistribution
+    question_stats: List[QuestionAnalytics]
+    outliers: List[StudentOutlier]
+
+class RubricEntry(BaseModel):
+    question_number: int
+    title: str
+    points_possible: Optional[float] = None
+    text: str
+
+class AnswerKey(BaseModel):
+    answer_key_id: str
+    filename: str
+    total_possible: Optional[float] = None
+    questions: List[RubricEntry]
+
+class BatchStudentStatus(BaseModel):
+    student_id: int
+    filename: str
+    status: str = "queued"
+    pages_done: int = 0
+    page_count: Optional[int] = None
+    error: Optional[str] = None
+    result: Optional[GradingResponse] = None
+
+class BatchJobStatus(BaseModel):
+    job_id: str
+    answer_key_id: Optional[str] = None
+    grading_mode: str = GRADING_MODE
+    status: str = "queued"
+    total: int
+    completed: int = 0
+    failed: int = 0
+    created_at: float
+    students: List[BatchStudentStatus]
+
+
+# Page rendering works entirely on in-memory buffers: pdfium renders each
+# page, it is preprocessed and JPEG-encoded, and the bytes go straight into
+# the request without a round-trip through the filesystem.
+
+def render_scale_for_budget(width: float, height: float, pixel_budget: int) -> float:
+    scale = (pixel_budget / max(width * height, 1.0)) ** 0.5
+    return min(RENDER_MAX_SCALE, max(RENDER_MIN_SCALE, scale))
+
+def prepare_page_image(page, pixel_budget: int = RENDER_PIXEL_BUDGET) -> Dict[str, Any]:
+    # Render one page for the vision model and report what it cost. "image"
+    # holds the JPEG bytes, or None when the page is blank. raw_bytes is the
+    # uncompressed bitmap size and payload_bytes the base64 size that
+    # actually goes into the request.
+    started = time.perf_counter()
+    scale = render_scale_for_budget(*page.get_size(), pixel_budget)
+    image = page.render(scale=scale, grayscale=RENDER_GRAYSCALE).to_pil()
+    raw_bytes = image.width * image.height * len(image.getbands())
 
-    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+    gray = image if image.mode == "L" else image.convert("L")
+    ink = gray.point(lambda value: 255 if value < INK_THRESHOLD else 0)
+    ink_ratio = ink.histogram()[255] / (image.width * image.height)
+    info = {
+        "image": None,
+        "scale": round(scale, 3),
+        "width": image.width,
+        "height": image.height,
+        "raw_bytes": raw_bytes,
+        "payload_bytes": 0,
+    }
+
+    bbox = ink.getbbox()
+    if bbox is not None and ink_ratio >= BLANK_PAGE_INK_RATIO:
+        if RENDER_CROP_MARGINS:
+            left, top, right, bottom = bbox
+            image = image.crop((
+                max(0, left - RENDER_CROP_PADDING),
+                max(0, top - RENDER_CROP_PADDING),
+                min(image.width, right + RENDER_CROP_PADDING),
+                min(image.height, bottom + RENDER_CROP_PADDING),
+            ))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        encoded = buffer.getvalue()
+        info.update({
+            "image": encoded,
+            "width": image.width,
+            "height": image.height,
+            "payload_bytes": 4 * ((len(encoded) + 2) // 3),
+        })
+
+    info["render_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return info
+
+def encode_image(image: bytes) -> str:
+    return base64.b64encode(image).decode('utf-8')
+
+EXTRACTION_SYSTEM_PROMPT = """
+                    You are an expert image analyzer that extracts text and describes visuals(documents, graphs, circuits, diagrams) from images. IMPORTANT! - If the page contains mathematical expressions, **transcribe them using plain text mathematical symbols (*, +, -, /, ^, √, ∫, ∂, ∑, etc.) rather than LaTeX format**
+                    Return your analysis in JSON format as an array of objects with these properties:
+                    - page_number: The sequential number of the image
+                    - text: The extracted text content
+                    - visual_description: Description of any visual elements
+                    - confidence_text: Confidence score for text extraction (0-1)
+                    - confidence_visual: Confidence score for visual description (0-1)
+                    """
+
+EXTRACTION_COMPLETION_PARAMS = {
+    "temperature": 1,
+    "max_completion_tokens": 8192,
+    "top_p": 1,
+    "stop": None,
+}
+# Expected completion tokens per page, reserved against the TPM limit up front
+EXTRACTION_COMPLETION_ESTIMATE = 600
 
+def build_extraction_messages(images: List[bytes], prompt: str) -> List[Dict]:
+    with track_stage("encode"):
+        return _build_extraction_messages(images, prompt)
+
+def _build_extraction_messages(images: List[bytes], prompt: str) -> List[Dict]:
     user_message = {
         "role": "user", 
         "content": [{"type": "text", "text": prompt}]
     }
     
-    for idx, image_path in enumerate(image_paths):
-        base64_image = encode_image(image_path)
+    for idx, image in enumerate(images):
+        base64_image = encode_image(image)
         user_message["content"].append({
             "type": "image_url",
             "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
             "page_number": idx + 1
         })
-    
+
+    return [{"role": "system", "content": EXTRACTION_SYSTEM_PROMPT}, user_message]
+
+def normalize_page_object(item: Any) -> Optional[Dict]:
+    if not isinstance(item, dict) or ("text" not in item and "visual_description" not in item):
+        return None
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": """
-                    You are an expert image analyzer that extracts text and describes visuals(documents, graphs, circuits, diagrams) from images. IMPORTANT! - If the page contains mathematical expressions, **transcribe them using plain text mathematical symbols (*, +, -, /, ^, √, ∫, ∂, ∑, etc.) rather than LaTeX format**
-                    Return your analysis in JSON format as an array of objects with these properties:
-                    - page_number: The sequential number of the image
-                    - text: The extracted text content
-                    - visual_description: Description of any visual elements
-                    - confidence_text: Confidence score for text extraction (0-1)
-                    - confidence_visual: Confidence score for visual description (0-1)
-                    """
-                },
-                user_message
-            ],
+        page_number = int(item["page_number"])
+        confidence_text = float(item.get("confidence_text") or 0.0)
+        confidence_visual = float(item.get("confidence_visual") or 0.0)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {
+        **item,
+        "page_number": page_number,
+        "text": str(item.get("text") or ""),
+        "visual_description": str(item.get("visual_description") or ""),
+        "confidence_text": confidence_text,
+        "confidence_visual": confidence_visual,
+    }
+
+class PageObjectParser:
+    # Incremental parser for the page objects in a vision response. Text can
+    # be fed in any number of pieces, e.g. as a streamed response arrives,
+    # and each page object is returned as soon as its closing brace does.
+    # It only tracks strings and brace nesting, so it finds the objects
+    # whether they come as a bare array, wrapped in {"extractions": [...]}
+    # or surrounded by prose, and an object that is not valid JSON is
+    # skipped without losing the pages around it.
+
+    def __init__(self):
+        self._text = ""
+        self._position = 0
+        self._in_string = False
+        self._escaped = False
+        # Offsets of the open braces, and whether each already holds a page
+        self._open: List[List] = []
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self._text += chunk
+        text = self._text
+        pages = []
+        for i in range(self._position, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._open.append([i, False])
+            elif char == "}" and self._open:
+                start, holds_page = self._open.pop()
+                if not holds_page:
+                    try:
+                        page = normalize_page_object(json.loads(text[start:i + 1], strict=False))
+                    except json.JSONDecodeError:
+                        page = None
+                    if page is not None:
+                        pages.append(page)
+                        holds_page = True
+                if holds_page and self._open:
+                    self._open[-1][1] = True
+        # Nothing before the outermost open brace can be part of a page
+        cut = self._open[0][0] if self._open else len(text)
+        self._text = text[cut:]
+        self._position = len(text) - cut
+        for entry in self._open:
+            entry[0] -= cut
+        return pages
+
+def parse_extraction_response(response_text: str) -> List[Dict]:
+    return PageObjectParser().feed(response_text)
+
+def merge_page_objects(found: Dict[int, List[Dict]], items: List[Dict], requested: List[int]):
+    # items are numbered from 1 within a call that sent the pages in
+    # `requested` (batch page numbers); file them under their batch page.
+    # A page that was already received is not overwritten.
+    received: Dict[int, List[Dict]] = {}
+    for item in items:
+        position = item["page_number"]
+        if 1 <= position <= len(requested):
+            page_number = requested[position - 1]
+        elif len(requested) == 1:
+            page_number = requested[0]
+        else:
+            continue
+        received.setdefault(page_number, []).append({**item, "page_number": page_number})
+    for page_number, page_items in received.items():
+        found.setdefault(page_number, page_items)
+
+class StreamedCompletion(NamedTuple):
+    items: List[Dict]
+    usage: Any
+
+def extraction_cache_key(images: List[bytes], prompt: str, model: str) -> str:
+    # Keyed on the rendered page bytes rather than the PDF, so the same sheet
+    # hits the cache no matter which upload or answer key it arrived with
+    parts = [model, EXTRACTION_SYSTEM_PROMPT, prompt]
+    parts += [sha256_hex(image) for image in images]
+    return sha256_hex("\0".join(parts).encode("utf-8"))
+
+def document_cache_key(document_id: str) -> str:
+    # Everything besides the file that decides which pages are rendered,
+    # how, and what the models are asked
+    parts = [
+        document_id, VISION_MODEL, REFINE_MODEL, EXTRACTION_SYSTEM_PROMPT, EXTRACTION_PROMPT,
+        TEXT_LAYER_MIN_CHARS, TEXT_LAYER_MIN_DENSITY, TEXT_LAYER_MAX_IMAGE_COVERAGE,
+        RENDER_PIXEL_BUDGET, RENDER_MIN_SCALE, RENDER_MAX_SCALE, RENDER_GRAYSCALE,
+        RENDER_CROP_MARGINS, RENDER_CROP_PADDING, JPEG_QUALITY, INK_THRESHOLD, BLANK_PAGE_INK_RATIO,
+        REFINE_MAX_PAGES, REFINE_BELOW_CONFIDENCE, REFINE_PIXEL_BUDGET,
+    ]
+    return sha256_hex("\0".join(str(part) for part in parts).encode("utf-8"))
+
+async def request_page_objects_async(images: List[bytes], prompt: str, model: str) -> List[Dict]:
+    # One streamed extraction call. Page objects are parsed as the response
+    # arrives, so if the stream breaks after some pages have come through,
+    # those pages are returned and only the rest need to be asked for again.
+    messages = await run_in_threadpool(build_extraction_messages, images, prompt)
+    client = get_async_groq_client()
+
+    async def call() -> StreamedCompletion:
+        from groq import APIConnectionError
+        parser = PageObjectParser()
+        items, usage = [], None
+        stream = await client.chat.completions.create(
+            messages=messages,
             model=model,
-            temperature=1,
-            max_completion_tokens=8192,
-            top_p=1,
-            stop=None,
+            stream=True,
+            **EXTRACTION_COMPLETION_PARAMS,
         )
-        
-        response_text = chat_completion.choices[0].message.content
-        
         try:
-            start_idx = response_text.find('[')
-            end_idx = response_text.rfind(']') + 1
-            
-            if start_idx >= 0 and end_idx > start_idx:
-                json_str = response_text[start_idx:end_idx]
-                data = json.loads(json_str)
-            else:
-                data = json.loads(response_text)
-                if isinstance(data, dict) and 'extractions' in data:
-                    data = data['extractions']
-            
-            return data
-        
-        except json.JSONDecodeError as je:
-            raise HTTPException(status_code=500, detail=f"Failed to parse JSON response: {je}")
-    
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    items += parser.feed(chunk.choices[0].delta.content)
+                # Groq sends the usage in the last chunk
+                x_groq = getattr(chunk, "x_groq", None)
+                usage = getattr(x_groq, "usage", None) or chunk.usage or usage
+        except (APIConnectionError, httpx.HTTPError):
+            if not items:
+                raise
+        finally:
+            await stream.close()
+        return StreamedCompletion(items, usage)
+
+    with track_stage("extract", model):
+        completion = await groq_scheduler.submit(
+            model,
+            account_prompt("extract", model, messages) + EXTRACTION_COMPLETION_ESTIMATE * len(images),
+            call,
+        )
+    record_llm_usage("extract", model, completion)
+    return completion.items
+
+async def extract_text_and_visuals_async(
+    images: List[bytes],
+    prompt: str,
+    num_images: Optional[int] = None,
+    model: str = VISION_MODEL
+) -> List[Dict]:
+
+    if num_images:
+        images = images[:num_images]
+
+    # Cache lookups and base64-encoding the page images block, so they go
+    # to the thread pool
+    cache_key = extraction_cache_key(images, prompt, model)
+    cached = await run_in_threadpool(extraction_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    found: Dict[int, List[Dict]] = {}
+    missing = list(range(1, len(images) + 1))
+
+    try:
+        # Pages missing from a response, or too malformed to parse, are
+        # asked for again on their own; the pages that did parse are kept
+        for _ in range(max(1, EXTRACTION_ATTEMPTS)):
+            items = await request_page_objects_async([images[n - 1] for n in missing], prompt, model)
+            merge_page_objects(found, items, missing)
+            missing = [n for n in missing if n not in found]
+            if not missing:
+                break
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during API call: {e}")
 
+    if missing:
+        raise HTTPException(
+            status_code=500,
+            detail=f"No valid transcription for page(s) {missing} after {EXTRACTION_ATTEMPTS} attempts",
+        )
+    data = [item for n in sorted(found) for item in found[n]]
+    await run_in_threadpool(extraction_cache.set, cache_key, data)
+    return data
+
 def extract_text_and_confidence(data: List[Dict]) -> Tuple[str, Dict[int, float]]:
     
     combined_text = ""
@@ -198,13 +1907,20 @@ def extract_text_and_confidence(data: List[Dict]) -> Tuple[str, Dict[int, float]
         confidence_text = item.get('confidence_text', 0.0)
         confidence_visual = item.get('confidence_visual', 0.0)
         
-        combined_text += f"--- Page {page_number} ---\n\n"
+        text = compact_text(text or '')
+        visual_desc = compact_text(visual_desc or '')
+        # Pages with nothing on them get no section of their own
+        if text or visual_desc:
+            combined_text += f"--- Page {page_number} ---\n"
         
         if text:
-            combined_text += f"{text}\n\n"
+            combined_text += f"{text}\n"
         
         if visual_desc:
-            combined_text += f"Visual Description:\n{visual_desc}\n\n"
+            combined_text += f"Visual Description: {visual_desc}\n"
+        
+        if text or visual_desc:
+            combined_text += "\n"
         
         if confidence_text > 0 and confidence_visual > 0:
             confidence_scores[page_number] = (confidence_text + confidence_visual) / 2
@@ -217,197 +1933,1200 @@ def extract_text_and_confidence(data: List[Dict]) -> Tuple[str, Dict[int, float]
     
     return combined_text, confidence_scores
 
-def process_pdf_to_text(pdf_path: str, output_folder: str, batch_size: int = 5) -> Tuple[str, Dict[int, float]]:
-    save_pdf_images(pdf_path, output_folder)
-    
-    combined_text = ""  
-    all_confidence_scores = {}  
-    page_offset = 0  
-    
-    while True:
-        image_paths = list_image_paths(output_folder, limit=batch_size)
-        if not image_paths:
-            break
-        
-        extraction_prompt = (
-        "You are given a scanned image of a handwritten answer sheet page.\n\n"
-        "You will be provided with a list of images containing handwritten text and visual content. The detailing should be consistent.\n\n"
-        "Your tasks:\n"
-        "1. If the page contains **handwritten text**, extract it ***exactly as it appears, maintaining original spelling, punctuation, line breaks, and spacing***. Use escape sequences like `\\n` for newlines and `\\t` for tabs to represent formatting.\n"
-        "2. If the page contains **visual content** (like graphs, circuits, diagrams), provide a detailed, structured **technical description**.\n\n"
-        "3. IMPORTANT! - If the page contains mathematical expressions, **transcribe them using plain text mathematical symbols (*, +, -, /, ^, √, ∫, ∂, ∑, etc.) rather than LaTeX format**. For example, write '∫ f(x) dx' or 'y = x²' instead of '$\\int f(x) dx$' or '$y = x^2$'.\n\n"
-        "Examples of mathematical notation to use:\n" 
-        "- Use ∂ for partial derivatives, not '\\partial'\n"
-        "- Use direct symbols like ∫, ∑, π, θ, ∞\n"
-        "- Use superscripts for powers (x²) or indicate with ^ (x^2)\n"
-        "- For fractions, use / or describe with clear structure (a/b)\n"
-        "- Use symbols like →, ≤, ≥, ≠, ≈ directly\n\n"
-        "Examples of what to include in a visual description:\n"
-        "- For graphs: axis labels, units, scale/step (e.g., 'x-axis ranges from 0 to 10 with step of 0.1V'), curves, line styles, arrows, legends.\n"
-        "- For circuits: all components, their arrangement, labels, and connections.\n"
-        "- For diagrams: shapes, annotations, labels, hierarchy.\n\n"
-        "DO NOT interpret or solve — just transcribe text, describe visuals, and transcribe mathematical expressions as seen.\n"
-        "Also give the confidence score of the text extraction and visual description of a page out of 1.\n\n"
-        "No need for any explanation or additional information.\n"
+# Sent with every extraction batch, so kept short; the output format is in
+# EXTRACTION_SYSTEM_PROMPT
+EXTRACTION_PROMPT = (
+    "Each image is one page of a handwritten answer sheet. Keep the level of detail consistent across pages.\n"
+    "1. Transcribe handwritten text exactly as written: spelling, punctuation, line breaks and spacing. "
+    "Use \\n for newlines and \\t for tabs.\n"
+    "2. For visual content, give a detailed technical description: graphs (axis labels, units, scale/step, "
+    "curves, line styles, arrows, legends), circuits (every component, its label and connections), "
+    "diagrams (shapes, annotations, labels, hierarchy).\n"
+    "3. Write math in plain-text symbols, not LaTeX: ∫ f(x) dx, y = x² or x^2, a/b, ∂, ∑, π, θ, ∞, →, ≤, ≥, ≠, ≈.\n"
+    "Do not interpret or solve anything. Give a 0-1 confidence for each page's text and visual description. "
+    "No explanations.\n"
+)
+
+def assign_page_numbers(data: List[Dict], page_indices: List[int]) -> List[Dict]:
+    # The model numbers pages within a batch from 1; map those back to
+    # document pages, which need not be contiguous
+    for item in data:
+        position = item.get('page_number', 1) - 1
+        if 0 <= position < len(page_indices):
+            item['page_number'] = page_indices[position] + 1
+        else:
+            item['page_number'] = page_indices[0] + position + 1
+    return data
+
+def discard_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# The functions below run inside the CPU process pool, so they take and
+# return only picklable values and raise plain exceptions.
+
+def prepare_pdf_page(pdf_path: str, index: int, pixel_budget: int = RENDER_PIXEL_BUDGET) -> Dict[str, Any]:
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return prepare_page_image(pdf[index], pixel_budget)
+    finally:
+        pdf.close()
+
+def count_pdf_pages(pdf_path: str) -> int:
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def inspect_pdf_page(page, index: int) -> Dict[str, Any]:
+    # Decide whether the page's embedded text layer is good enough to skip
+    # the vision model. Typed submissions have plenty of text and few images;
+    # scans are one large image, often with no text at all, and printed
+    # question papers with handwriting on them have a little text on top of
+    # a page-sized image.
+    import pypdfium2.raw as pdfium_c
+    width, height = page.get_size()
+    page_area = max(width * height, 1.0)
+    text = page.get_textpage().get_text_range()
+    chars = sum(1 for c in text if not c.isspace())
+    density = chars / (page_area / (72 * 72))
+
+    image_area = 0.0
+    for image in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE]):
+        left, bottom, right, top = image.get_bounds()
+        image_area += max(0.0, right - left) * max(0.0, top - bottom)
+    image_coverage = min(1.0, image_area / page_area)
+
+    use_text_layer = (
+        chars >= TEXT_LAYER_MIN_CHARS
+        and density >= TEXT_LAYER_MIN_DENSITY
+        and image_coverage <= TEXT_LAYER_MAX_IMAGE_COVERAGE
     )
+    return {
+        "index": index,
+        "route": "text_layer" if use_text_layer else "vision",
+        "text": text.replace("\r\n", "\n") if use_text_layer else "",
+        "chars": chars,
+        "text_density": round(density, 2),
+        "image_coverage": round(image_coverage, 3),
+    }
+
+def inspect_and_prepare_pdf_page(pdf_path: str, index: int, render: bool = True) -> Dict[str, Any]:
+    # Inspect one page and, if it needs the vision model and render is set,
+    # render it in the same pass; the rendering is under "prepared"
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        page = pdf[index]
+        inspection = inspect_pdf_page(page, index)
+        if render and inspection["route"] == "vision":
+            inspection["prepared"] = prepare_page_image(page)
+        return inspection
+    finally:
+        pdf.close()
+
+def read_pdf_text(pdf_path: str) -> str:
+    import PyPDF2
+    extracted_text = ""
+    with open(pdf_path, "rb") as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
         
-        data = extract_text_and_visuals(image_paths, extraction_prompt, num_images=batch_size)
-        
-        if data:
-            for item in data:
-                item['page_number'] = item.get('page_number', 0) + page_offset
-            
-            batch_text, batch_confidence = extract_text_and_confidence(data)
-            combined_text += batch_text
-            
-            all_confidence_scores.update(batch_confidence)
-            
-            page_offset += len(image_paths)
-        
-        delete_first_n_images(output_folder, n=batch_size)
+        for page in reader.pages:
+            extracted_text += page.extract_text() + "\n"
     
-    return combined_text.strip(), all_confidence_scores
+    return extracted_text
 
-def extract_text_from_pdf(pdf_path):
-    extracted_text = ""
+async def refine_page(pdf_path: str, index: int) -> Optional[List[Dict]]:
+    # Second attempt at a page the first pass was unsure of. Returns None
+    # when it fails, in which case the first transcription stands.
+    async with render_slots:
+        with track_stage("render"):
+            prepared = await run_in_cpu_pool(prepare_pdf_page, pdf_path, index, REFINE_PIXEL_BUDGET)
+    if prepared["image"] is None:
+        return None
     try:
-        with open(pdf_path, "rb") as pdf_file:
-            reader = PyPDF2.PdfReader(pdf_file)
-            
-            for page in reader.pages:
-                extracted_text += page.extract_text() + "\n"
+        data = await extract_text_and_visuals_async(
+            [prepared["image"]], EXTRACTION_PROMPT, num_images=1, model=REFINE_MODEL
+        )
+    except HTTPException:
+        return None
+    data = assign_page_numbers(data or [], [index])
+    for item in data:
+        item["refined"] = True
+    return data
+
+async def process_pdf_to_text_async(
+    pdf_path: str,
+    batch_size: int = 5,
+    concurrency: int = EXTRACTION_CONCURRENCY,
+    on_pages: Optional[Callable[[List[Dict], int], None]] = None,
+    done_pages: Optional[Dict[int, List[Dict]]] = None,
+    document_id: Optional[str] = None,
+) -> Tuple[str, Dict[int, float], List[Dict]]:
+    # Returns the combined transcript, per-page confidence and a per-page
+    # report of which path (text_layer or vision) each page took.
+    # on_pages, if given, is called with each batch's page extractions (page
+    # numbers already absolute) and the document's page count as soon as the
+    # batch comes back, in completion order rather than page order. A page
+    # the refinement pass improves is reported again, marked "refined".
+    # done_pages maps page numbers to extractions from an earlier, interrupted
+    # run; those pages are neither rendered nor sent again. document_id is the
+    # file's SHA-256; with it, a document extracted before is served whole
+    # from the document cache.
+    if document_id is not None:
+        cache_key = document_cache_key(document_id)
+        cached = await run_in_threadpool(document_cache.get, cache_key)
+        if cached is not None:
+            if on_pages is not None:
+                on_pages(cached["pages"], len(cached["reports"]))
+            combined_text, all_confidence_scores = extract_text_and_confidence(cached["pages"])
+            return combined_text.strip(), all_confidence_scores, cached["reports"]
+
+    done_pages = done_pages or {}
+    batch_size = max(1, batch_size)
+    concurrency = max(1, concurrency)
+
+    # Rendering happens in the CPU pool, batches wait on a bounded queue and a fixed set of extraction tasks
+    # drains it, so at most `concurrency` encoded batches are ever alive.
+    batch_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    pages: List[Dict] = []
+    page_reports: Dict[int, Dict] = {}
+    page_count = 0
+    # Extraction tasks waiting for a batch. Until the first batch is sent, a
+    # page goes out on its own as soon as one of them is idle, so the first
+    # pages do not wait for a full batch to be rendered; after that, pages
+    # are batched to keep the number of calls down.
+    idle_extractors = 0
+
+    def add_pages(data: List[Dict]):
+        pages.extend(data)
+        if on_pages is not None:
+            on_pages(data, page_count)
+
+    async def render_batches():
+        nonlocal page_count
+        page_count = await run_in_cpu_pool(count_pdf_pages, pdf_path)
+
+        # Each page is inspected just before it would be rendered, so the
+        # first batch does not wait for the whole document to be inspected
+        page_indices, batch = [], []
+        batches_sent = 0
+        for i in range(page_count):
+            async with render_slots:
+                with track_stage("render"):
+                    inspection = await run_in_cpu_pool(
+                        inspect_and_prepare_pdf_page, pdf_path, i, i + 1 not in done_pages
+                    )
+            report = {key: inspection[key] for key in ("route", "chars", "text_density", "image_coverage")}
+            page_reports[i] = {"page_number": i + 1, **report}
+            if inspection["route"] == "text_layer":
+                add_pages([{
+                    "page_number": i + 1,
+                    "text": inspection["text"],
+                    "visual_description": "",
+                    "confidence_text": 1.0,
+                    "confidence_visual": 0.0,
+                }])
+                continue
+            if "prepared" not in inspection:
+                page_reports[i]["route"] = "resumed"
+                pages.extend(done_pages[i + 1])
+                continue
+            prepared = inspection["prepared"]
+            image = prepared.pop("image")
+            page_reports[i].update(prepared)
+            if image is None:
+                page_reports[i]["route"] = "blank"
+                continue
+            page_indices.append(i)
+            batch.append(image)
+            if len(batch) == batch_size or (not batches_sent and idle_extractors > batch_queue.qsize()):
+                await batch_queue.put((page_indices, batch))
+                batches_sent += 1
+                page_indices, batch = [], []
+        if batch:
+            await batch_queue.put((page_indices, batch))
+        for _ in range(concurrency):
+            await batch_queue.put(None)
+
+    async def extract_batches():
+        nonlocal idle_extractors
+        while True:
+            idle_extractors += 1
+            try:
+                item = await batch_queue.get()
+            finally:
+                idle_extractors -= 1
+            if item is None:
+                return
+            page_indices, images = item
+            # Drop the queue's reference so the buffers are freed as soon as
+            # the request has been sent
+            item = None
+            started = time.perf_counter()
+            data = await extract_text_and_visuals_async(images, EXTRACTION_PROMPT, num_images=len(images))
+            images = None
+            extract_ms = round((time.perf_counter() - started) * 1000, 1)
+            for i in page_indices:
+                page_reports[i]["extract_ms"] = extract_ms
+            add_pages(assign_page_numbers(data or [], page_indices))
+
+    # The extraction tasks start first, so they are already waiting when the
+    # first page is ready
+    tasks = [asyncio.create_task(extract_batches()) for _ in range(concurrency)]
+    tasks.append(asyncio.create_task(render_batches()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Only the least confident pages are refined, so the pass costs at most
+    # REFINE_MAX_PAGES calls however long the paper is. Pages refined by an
+    # earlier, interrupted run are not refined twice.
+    scores = extract_text_and_confidence(pages)[1]
+    already_refined = {item.get("page_number") for item in pages if item.get("refined")}
+    candidates = sorted(
+        (score, page_number)
+        for page_number, score in scores.items()
+        if score < REFINE_BELOW_CONFIDENCE
+        and page_number not in already_refined
+        and page_reports.get(page_number - 1, {}).get("route") in ("vision", "resumed")
+    )[:max(0, REFINE_MAX_PAGES)]
+    if candidates:
+        with track_stage("refine"):
+            refined = await asyncio.gather(*[
+                refine_page(pdf_path, page_number - 1) for _, page_number in candidates
+            ])
+        for (score, page_number), data in zip(candidates, refined):
+            if not data or extract_text_and_confidence(data)[1].get(page_number, 0.0) <= score:
+                continue
+            pages[:] = [item for item in pages if item.get("page_number") != page_number]
+            add_pages(data)
+            page_reports[page_number - 1]["refined"] = True
+
+    # extract_text_and_confidence sorts by page number, restoring page order
+    combined_text, all_confidence_scores = extract_text_and_confidence(pages)
+    reports = [page_reports[i] for i in sorted(page_reports)]
+    for report in reports:
+        report["confidence"] = all_confidence_scores.get(report["page_number"])
+    if document_id is not None:
+        await run_in_threadpool(document_cache.set, cache_key, {"pages": pages, "reports": reports})
+    return combined_text.strip(), all_confidence_scores, reports
+
+async def extract_text_from_pdf_async(pdf_path: str) -> str:
+    try:
+        with track_stage("pdf_text"):
+            return await run_in_cpu_pool(read_pdf_text, pdf_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while extracting text: {e}")
-    
-    return extracted_text
 
-def grade_student_answers(answer_key: str, student_answer: str) -> Dict:
-    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-    
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": """
-                    You are an expert evaluator grading student answers against an answer key. 
-                    Evaluate each student response based on the marking scheme provided in the answer key. Verify whether the required points are awarded for the corresponding criteria and ensure that the content is sufficiently detailed and comprehensive for the allocated marks.
-                    The output must be in JSON format following this schema:
-                    {
-                        "total_score": ,
-                        "total_possible": ,
-                        "percentage": ,
-                        "questions": [
-                            {
-                                "question_number": ,
-                                "points_earned": ,
-                                "points_possible": ,
-                                "justification": "",
-                                "feedback": ""
-                            }
-                            // More items for each question...
-                        ]
-                    }
-                    The total_score should be the sum of points_earned for each question.
-                    """
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                    ANSWER KEY:
-                    {answer_key}
-
-                    STUDENT ANSWER:
-                    {student_answer}
-
-                    Instructions:
-                    1. Compare each student response to the corresponding question in the answer key.
-                    2. Award points based on how well the student answer matches the criteria in the marking scheme.
-                    3. Provide brief justification for each score.
-                    4. Calculate the total score earned correctly.
-                    5. Provide feedback for each question 
-                    """
-                }
-            ],
-            model="meta-llama/llama-4-maverick-17b-128e-instruct",
-            temperature=0,
-            stream=False,
-            response_format={"type": "json_object"},
+QUESTION_HEADER_PATTERN = re.compile(
+    r"^[ \t]*(?:question|q)[ \t]*\.?[ \t]*(\d+)\b[ \t]*[:.)\-]?[ \t]*(.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+POINTS_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(?:marks?|points?|pts)\b", re.IGNORECASE)
+
+def split_answer_key(answer_key_text: str) -> List[Dict]:
+    # Each "Question N" / "QN" header starts a rubric entry that runs until the
+    # next header. Keys without recognisable headers produce no entries and
+    # are graded as a whole. Repeated headers for one number, as in "Q1 a)"
+    # and "Q1 b)", are parts of the same question and become one entry.
+    headers = list(QUESTION_HEADER_PATTERN.finditer(answer_key_text))
+    parts: Dict[int, List[Dict]] = {}
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(answer_key_text)
+        title = header.group(2).strip()
+        points = POINTS_PATTERN.search(title)
+        parts.setdefault(int(header.group(1)), []).append({
+            "title": title,
+            "points_possible": float(points.group(1)) if points else None,
+            "text": answer_key_text[header.start():end].strip(),
+        })
+    return [
+        {
+            "question_number": number,
+            "title": entries[0]["title"],
+            "points_possible": merged_points([entry["points_possible"] for entry in entries]),
+            "text": "\n\n".join(entry["text"] for entry in entries),
+        }
+        for number, entries in parts.items()
+    ]
+
+def merged_points(points: List[Optional[float]]) -> Optional[float]:
+    # Points of a question split over several headers: the first header's
+    # when it gives the question's total (alone, or equal to the parts'
+    # sum), otherwise the sum of the parts that state theirs
+    stated = [value for value in points if value is not None]
+    if not stated:
+        return None
+    first, rest = points[0], [value for value in points[1:] if value is not None]
+    if first is not None and (not rest or first == sum(rest)):
+        return first
+    return sum(stated)
+
+def answer_key_summary(answer_key: Dict[str, Any]) -> AnswerKey:
+    points = [entry["points_possible"] for entry in answer_key["rubric"]]
+    return AnswerKey(
+        answer_key_id=answer_key["answer_key_id"],
+        filename=answer_key["filename"],
+        total_possible=sum(points) if points and None not in points else None,
+        questions=answer_key["rubric"],
+    )
+
+async def compile_answer_key(pdf_path: str, filename: str, document_id: Optional[str] = None) -> Dict[str, Any]:
+    # The ID is derived from the file contents, so uploading the same key
+    # twice returns the existing entry instead of creating a new one.
+    # document_id is the file's SHA-256 when the caller already has it.
+    document_id = document_id or await run_in_threadpool(sha256_file, pdf_path)
+    answer_key_id = document_id[:32]
+    existing = await run_in_threadpool(answer_key_store.load, answer_key_id)
+    if existing is not None:
+        return existing
+
+    text = await extract_text_from_pdf_async(pdf_path)
+    rubric = split_answer_key(text)
+    await run_in_threadpool(answer_key_store.save, answer_key_id, filename, text, rubric)
+    return {"answer_key_id": answer_key_id, "filename": filename, "text": text, "rubric": rubric}
+
+async def load_answer_key_text(answer_key_id: str) -> str:
+    answer_key = await run_in_threadpool(answer_key_store.load, answer_key_id)
+    if answer_key is None:
+        raise HTTPException(status_code=404, detail=f"Answer key {answer_key_id} not found")
+    return answer_key["text"]
+
+GRADING_SYSTEM_PROMPT = """You are an expert evaluator grading student answers against an answer key.
+Evaluate each student response based on the marking scheme provided in the answer key. Verify whether the required points are awarded for the corresponding criteria and ensure that the content is sufficiently detailed and comprehensive for the allocated marks.
+The output must be a JSON object following this schema:
+{"total_score": , "total_possible": , "percentage": , "questions": [{"question_number": , "points_earned": , "points_possible": , "justification": "", "feedback": ""}, ...one item per question]}
+The total_score should be the sum of points_earned for each question."""
+
+GRADING_COMPLETION_PARAMS = {
+    "model": GRADING_MODEL,
+    "temperature": 0,
+    "stream": False,
+    "response_format": {"type": "json_object"},
+}
+GRADING_COMPLETION_ESTIMATE = 1500
+QUESTION_GRADING_COMPLETION_ESTIMATE = 300
+
+GRADING_INSTRUCTIONS = (
+    "Instructions:\n"
+    "1. Compare each student response to the corresponding question in the answer key.\n"
+    "2. Award points based on how well the student answer matches the criteria in the marking scheme.\n"
+    "3. Provide brief justification for each score.\n"
+    "4. Calculate the total score earned correctly.\n"
+    "5. Provide feedback for each question.\n"
+)
+
+def grading_user_content(answer_key: str, student_answer: str) -> str:
+    return f"ANSWER KEY:\n{answer_key}\n\nSTUDENT ANSWER:\n{student_answer}\n\n{GRADING_INSTRUCTIONS}"
+
+def build_grading_messages(answer_key: str, student_answer: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+        {"role": "user", "content": grading_user_content(compact_text(answer_key), compact_text(student_answer))},
+    ]
+
+def grading_cache_key(messages: List[Dict]) -> str:
+    # Keyed on the prompt as sent, so a change to how transcripts are packed
+    # is never served an old grade
+    parts = [GRADING_MODEL] + [sha256_hex(message["content"].encode("utf-8")) for message in messages]
+    return sha256_hex("\0".join(parts).encode("utf-8"))
+
+async def grade_student_answers_async(answer_key: str, student_answer: str) -> Dict:
+    messages = build_grading_messages(answer_key, student_answer)
+    tokens = prompt_over_budget("grade", messages, GRADING_TOKEN_BUDGET)
+    if tokens is not None:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The grading prompt is about {tokens} tokens, over EVALO_GRADING_TOKEN_BUDGET "
+            f"({GRADING_TOKEN_BUDGET}), and the paper has no question numbers to grade it question by question",
         )
-        
+    cache_key = grading_cache_key(messages)
+    cached = await run_in_threadpool(grading_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    client = get_async_groq_client()
+
+    try:
+        with track_stage("grade", GRADING_MODEL):
+            chat_completion = await groq_scheduler.submit(
+                GRADING_MODEL,
+                account_prompt("grade", GRADING_MODEL, messages) + GRADING_COMPLETION_ESTIMATE,
+                lambda: client.chat.completions.create(
+                    messages=messages,
+                    **GRADING_COMPLETION_PARAMS,
+                ),
+            )
+        record_llm_usage("grade", GRADING_MODEL, chat_completion)
+
         response_text = chat_completion.choices[0].message.content
-        return json.loads(response_text)
-        
+        result = json.loads(response_text)
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during grading API call: {e}")
 
+    await run_in_threadpool(grading_cache.set, cache_key, result)
+    return result
+
+QUESTION_GRADING_SYSTEM_PROMPT = """You are an expert evaluator grading one student answer against the marking scheme for that question.
+Verify whether the required points are awarded for the corresponding criteria and ensure that the content is sufficiently detailed and comprehensive for the allocated marks.
+The output must be a JSON object following this schema:
+{"question_number": , "points_earned": , "points_possible": , "justification": "", "feedback": ""}"""
+
+# Question markers in a student transcript: "Q1", "Question 1", "Ans 1", or a
+# bare "1." / "1)" at the start of a line
+STUDENT_QUESTION_PATTERN = re.compile(
+    r"^[ \t>*#\-]*(?:(?:question|ques|qn|q|answer|ans)[ \t]*\.?[ \t]*(\d+)|(\d+)[ \t]*[.):])",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+def align_answers_to_questions(student_text: str, question_numbers: List[int]) -> Dict[int, str]:
+    # Split the transcript at the first marker for each rubric question.
+    # Explicit markers ("Q2") win; bare numbers are only used when there are
+    # none, and then only in ascending order, since numbered steps inside an
+    # answer look the same.
+    wanted = set(question_numbers)
+    markers = [
+        (match.start(), int(match.group(1) or match.group(2)), match.group(1) is not None)
+        for match in STUDENT_QUESTION_PATTERN.finditer(student_text)
+    ]
+    if any(explicit for _, _, explicit in markers):
+        markers = [marker for marker in markers if marker[2]]
+
+    starts = []
+    for position, number, explicit in markers:
+        if number not in wanted or number in {n for _, n in starts}:
+            continue
+        if not explicit and starts and number < starts[-1][1]:
+            continue
+        starts.append((position, number))
+
+    segments = {}
+    for i, (position, number) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else len(student_text)
+        segments[number] = student_text[position:end].strip()
+    return segments
+
+def question_grading_user_content(entry: Dict, scheme: str, student_answer: str) -> str:
+    points = entry.get("points_possible")
+    return (
+        f"QUESTION {entry['question_number']} MARKING SCHEME"
+        + (f" ({points:g} points)" if points is not None else "")
+        + f":\n{scheme}\n\n"
+        f"STUDENT ANSWER:\n{student_answer}\n\n"
+        "Instructions:\n"
+        f"1. Grade only question {entry['question_number']}; ignore any other questions in the student answer.\n"
+        "2. Award points based on how well the student answer matches the criteria in the marking scheme.\n"
+        "3. Provide brief justification for the score.\n"
+        "4. Provide feedback for the student.\n"
+    )
+
+def build_question_grading_messages(entry: Dict, student_answer: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": QUESTION_GRADING_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": question_grading_user_content(entry, compact_text(entry["text"]), compact_text(student_answer)),
+        },
+    ]
+
+def normalize_question_grade(result: Dict, entry: Dict) -> Dict:
+    # The rubric's points are authoritative when the key states them, and
+    # the awarded points are clamped to the valid range
+    points_possible = entry.get("points_possible")
+    if points_possible is None:
+        points_possible = float(result["points_possible"])
+    points_earned = min(max(float(result["points_earned"]), 0.0), points_possible)
+    return {
+        "question_number": entry["question_number"],
+        "points_earned": points_earned,
+        "points_possible": points_possible,
+        "justification": str(result.get("justification") or ""),
+        "feedback": str(result.get("feedback") or ""),
+    }
+
+async def grade_question_async(entry: Dict, student_answer: str) -> Dict:
+    messages = build_question_grading_messages(entry, student_answer)
+    tokens = prompt_over_budget("grade_question", messages, QUESTION_GRADING_TOKEN_BUDGET)
+    if tokens is not None:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The grading prompt for question {entry['question_number']} is about {tokens} tokens, "
+            f"over EVALO_QUESTION_GRADING_TOKEN_BUDGET ({QUESTION_GRADING_TOKEN_BUDGET})",
+        )
+    cache_key = sha256_hex("\0".join([
+        GRADING_MODEL,
+        QUESTION_GRADING_SYSTEM_PROMPT,
+        sha256_hex(messages[1]["content"].encode("utf-8")),
+    ]).encode("utf-8"))
+    cached = await run_in_threadpool(grading_cache.get, cache_key)
+    if cached is not None:
+        return cached
+
+    client = get_async_groq_client()
+    last_error = None
+    # The scheduler already retries transient API errors; these attempts
+    # cover malformed or incomplete JSON, for this question alone
+    for _ in range(max(1, QUESTION_GRADING_ATTEMPTS)):
+        try:
+            with track_stage("grade_question", GRADING_MODEL):
+                chat_completion = await groq_scheduler.submit(
+                    GRADING_MODEL,
+                    account_prompt("grade_question", GRADING_MODEL, messages) + QUESTION_GRADING_COMPLETION_ESTIMATE,
+                    lambda: client.chat.completions.create(
+                        messages=messages,
+                        **GRADING_COMPLETION_PARAMS,
+                    ),
+                )
+            record_llm_usage("grade_question", GRADING_MODEL, chat_completion)
+            result = normalize_question_grade(
+                json.loads(chat_completion.choices[0].message.content), entry
+            )
+            break
+        except Exception as e:
+            last_error = e
+    else:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error grading question {entry['question_number']}: {last_error}",
+        )
+
+    await run_in_threadpool(grading_cache.set, cache_key, result)
+    return result
+
+async def grade_student_answers_per_question_async(
+    answer_key: str,
+    student_answer: str,
+    on_question: Optional[Callable[[Dict], None]] = None,
+    done_questions: Optional[Dict[int, Dict]] = None,
+) -> Dict:
+    # Falls back to a single grading call when the key has no recognisable
+    # question headers or the transcript has no question markers at all.
+    # Questions in done_questions were graded by an earlier run and are
+    # reused as they are.
+    done_questions = done_questions or {}
+    rubric = split_answer_key(answer_key)
+    segments = align_answers_to_questions(
+        student_answer, [entry["question_number"] for entry in rubric]
+    )
+    if not rubric or not segments:
+        result = await grade_student_answers_async(answer_key, student_answer)
+        for question in result.get("questions", []):
+            if on_question is not None:
+                on_question(question)
+        return result
+
+    async def grade(entry: Dict) -> Dict:
+        if entry["question_number"] in done_questions:
+            return done_questions[entry["question_number"]]
+        # A question with no marker of its own is graded against the whole
+        # transcript rather than scored zero outright
+        answer = segments.get(entry["question_number"], student_answer)
+        question = await grade_question_async(entry, answer)
+        if on_question is not None:
+            on_question(question)
+        return question
+
+    questions = await gather_or_cancel(*[grade(entry) for entry in rubric])
+    total_score = sum(question["points_earned"] for question in questions)
+    total_possible = sum(question["points_possible"] for question in questions)
+    return {
+        "total_score": round(total_score, 2),
+        "total_possible": round(total_possible, 2),
+        "percentage": round(total_score / total_possible * 100, 2) if total_possible else 0.0,
+        "questions": sorted(questions, key=lambda question: question["question_number"]),
+    }
+
+def upload_too_large(name: str, max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"{name} is larger than the {max_bytes / (1024 * 1024):g} MB limit",
+    )
+
+def save_upload(upload: UploadFile, path: str, max_bytes: int):
+    if upload.size is not None and upload.size > max_bytes:
+        raise upload_too_large(upload.filename or "upload", max_bytes)
+    try:
+        with open(path, "wb") as f:
+            copy_limited(upload.file, f, max_bytes)
+    except UploadTooLarge:
+        raise upload_too_large(upload.filename or "upload", max_bytes)
+
+def store_pdf_file(source: BinaryIO, name: str, size: Optional[int] = None) -> Dict[str, Any]:
+    # Blocking part of store_pdf: size checks and the single pass that hashes
+    # and stores the file
+    if size is not None and size > MAX_UPLOAD_BYTES:
+        raise upload_too_large(name, MAX_UPLOAD_BYTES)
+    try:
+        stored = upload_store.put(source, MAX_UPLOAD_BYTES)
+    except UploadTooLarge:
+        raise upload_too_large(name, MAX_UPLOAD_BYTES)
+    metrics.inc("evalo_uploads_total", result="reused" if stored["reused"] else "stored")
+    metrics.inc("evalo_upload_bytes_total", stored["size"])
+    return stored
+
+async def check_stored_pdf(stored: Dict[str, Any], name: str) -> Dict[str, Any]:
+    # Page count limit, checked before any page is rendered. A stored file's
+    # page count is remembered, so a repeat upload is not opened again.
+    if stored["page_count"] is None:
+        try:
+            stored["page_count"] = await run_in_cpu_pool(count_pdf_pages, stored["path"])
+        except Exception:
+            if not stored["reused"]:
+                await run_in_threadpool(upload_store.discard, stored["document_id"])
+            raise HTTPException(status_code=400, detail=f"{name} is not a readable PDF")
+        await run_in_threadpool(upload_store.set_page_count, stored["document_id"], stored["page_count"])
+    if stored["page_count"] > MAX_PDF_PAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{name} has {stored['page_count']} pages; the limit is {MAX_PDF_PAGES}",
+        )
+    return stored
+
+async def store_pdf(upload: UploadFile) -> Dict[str, Any]:
+    # Returns the stored file's document_id (its SHA-256), path, size and
+    # page count. The path is shared by every upload of the same content and
+    # must not be modified or deleted.
+    name = os.path.basename(upload.filename or "upload.pdf")
+    stored = await run_in_threadpool(store_pdf_file, upload.file, name, upload.size)
+    return await check_stored_pdf(stored, name)
+
+def link_or_copy(source: str, target: str):
+    # Hard links share the stored file without copying it; the copy is for
+    # job directories on another filesystem
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def validate_grading_mode(grading_mode: str) -> str:
+    if grading_mode not in GRADING_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"grading_mode must be one of {', '.join(GRADING_MODES)}",
+        )
+    return grading_mode
+
+async def gather_or_cancel(*aws: Awaitable) -> List[Any]:
+    # asyncio.gather, except that the first failure cancels the rest
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def grade_paper(
+    student_pdf_path: str,
+    answer_key: Union[str, Awaitable[str]],
+    on_pages: Optional[Callable[[List[Dict], int], None]] = None,
+    on_stage: Optional[Callable[[str], None]] = None,
+    on_question: Optional[Callable[[Dict], None]] = None,
+    grading_mode: str = GRADING_MODE,
+    done_pages: Optional[Dict[int, List[Dict]]] = None,
+    done_questions: Optional[Dict[int, Dict]] = None,
+    document_id: Optional[str] = None,
+) -> Dict:
+    # answer_key is either the key text or an awaitable producing it; in the
+    # latter case it is resolved concurrently with the student's pages.
+    # on_stage is called with "grading" once every page has been extracted,
+    # and on_question with each question's grade as soon as it is known.
+    # done_pages and done_questions carry progress over from an interrupted
+    # run, and document_id is the PDF's SHA-256; see
+    # process_pdf_to_text_async.
+    async def resolve_answer_key():
+        return answer_key if isinstance(answer_key, str) else await answer_key
+
+    # Rendering and parsing run in the CPU pool, vision calls on the loop.
+    # If either side fails the other is cancelled, so no vision calls are
+    # made for a paper that cannot be graded.
+    (student_text, confidence_scores, page_reports), answer_key_text = await gather_or_cancel(
+        process_pdf_to_text_async(
+            student_pdf_path,
+            batch_size=EXTRACTION_BATCH_SIZE,
+            on_pages=on_pages,
+            done_pages=done_pages,
+            document_id=document_id,
+        ),
+        resolve_answer_key(),
+    )
+
+    if on_stage is not None:
+        on_stage("grading")
+    if grading_mode == "single" and prompt_over_budget(
+        "grade", build_grading_messages(answer_key_text, student_text), GRADING_TOKEN_BUDGET
+    ):
+        # Too long for one prompt: graded question by question instead,
+        # which only fails if the paper cannot be split into questions
+        grading_mode = "per_question"
+    if grading_mode == "per_question":
+        grading_result = await grade_student_answers_per_question_async(
+            answer_key_text, student_text, on_question, done_questions
+        )
+    else:
+        grading_result = await grade_student_answers_async(answer_key_text, student_text)
+        for question in grading_result.get("questions", []):
+            if on_question is not None:
+                on_question(question)
+    grading_result["pages"] = page_reports
+    return grading_result
+
+async def compiled_answer_key_text(stored: Dict[str, Any], filename: str) -> str:
+    answer_key = await compile_answer_key(stored["path"], filename, stored["document_id"])
+    return answer_key["text"]
+
+async def store_grading_uploads(
+    student_pdf: UploadFile,
+    answer_key_pdf: Optional[UploadFile],
+    answer_key_id: Optional[str],
+) -> Tuple[Dict[str, Any], Union[str, Awaitable[str]]]:
+    # Returns the stored student PDF (see store_pdf) and the key text, or for
+    # an uploaded key an awaitable for it. A stored key is looked up first,
+    # so an unknown answer_key_id fails before anything else is done; an
+    # uploaded key is compiled like one sent to /answer-keys, so sending the
+    # same key again skips its extraction.
+    if (answer_key_pdf is None) == (answer_key_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide exactly one of answer_key_pdf or answer_key_id",
+        )
+
+    if answer_key_id is not None:
+        answer_key_text = await load_answer_key_text(answer_key_id)
+        return await store_pdf(student_pdf), answer_key_text
+
+    student = await store_pdf(student_pdf)
+    answer_key = await store_pdf(answer_key_pdf)
+    return student, compiled_answer_key_text(answer_key, os.path.basename(answer_key_pdf.filename or ""))
+
 @app.post("/process-pdfs", response_model=GradingResponse)
 async def process_pdfs(
     student_pdf: UploadFile = File(...),
-    answer_key_pdf: UploadFile = File(...)
+    answer_key_pdf: Optional[UploadFile] = File(None),
+    answer_key_id: Optional[str] = Form(None),
+    grading_mode: str = Form(GRADING_MODE),
+    include_timings: bool = Form(False)
 ):
-    # Create temp directories for processing
-    temp_dir = tempfile.mkdtemp()
-    output_folder = os.path.join(temp_dir, "images")
-    os.makedirs(output_folder, exist_ok=True)
+    validate_grading_mode(grading_mode)
+    trace = RequestTrace()
+    current_trace.set(trace)
     
     try:
-        # Save uploaded files to temp location
-        student_pdf_path = os.path.join(temp_dir, student_pdf.filename)
-        answer_key_path = os.path.join(temp_dir, answer_key_pdf.filename)
-        
-        with open(student_pdf_path, "wb") as f:
-            shutil.copyfileobj(student_pdf.file, f)
-        
-        with open(answer_key_path, "wb") as f:
-            shutil.copyfileobj(answer_key_pdf.file, f)
-        
-        # Process student PDF
-        student_text, confidence_scores = process_pdf_to_text(student_pdf_path, output_folder, batch_size=1)
-        
-        # Extract text from answer key
-        answer_key_text = extract_text_from_pdf(answer_key_path)
-        
-        # Grade student answers
-        grading_result = grade_student_answers(answer_key_text, student_text)
-        
+        student, answer_key_text = await store_grading_uploads(student_pdf, answer_key_pdf, answer_key_id)
+        grading_result = await grade_paper(
+            student["path"],
+            answer_key_text,
+            grading_mode=grading_mode,
+            document_id=student["document_id"],
+        )
+        if include_timings:
+            grading_result["timings"] = trace.summary()
         return grading_result
         
+    except HTTPException:
+        raise
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
-    finally:
-       
-    # Clean up temporary files with better error handling
+
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/process-pdfs/stream")
+async def process_pdfs_stream(
+    request: Request,
+    student_pdf: UploadFile = File(...),
+    answer_key_pdf: Optional[UploadFile] = File(None),
+    answer_key_id: Optional[str] = Form(None),
+    grading_mode: str = Form(GRADING_MODE),
+    include_timings: bool = Form(False)
+):
+    # Server-Sent Events version of /process-pdfs. Emits a "page" event as
+    # each page is extracted, "grading" once extraction is done, a
+    # "question" event as each question is graded, then "result" with the
+    # same body /process-pdfs returns. Failures end the stream with an
+    # "error" event.
+    validate_grading_mode(grading_mode)
+    # The uploads are stored before the response starts, since the
+    # request's files are closed once the handler returns
+    student, answer_key_text = await store_grading_uploads(student_pdf, answer_key_pdf, answer_key_id)
+
+    events: asyncio.Queue = asyncio.Queue()
+    pages_done = 0
+
+    def on_pages(pages: List[Dict], page_count: int):
+        nonlocal pages_done
+        # A refined page replaces one that was already reported
+        pages_done += sum(1 for page in pages if not page.get("refined"))
+        for page in sorted(pages, key=lambda page: page.get("page_number", 0)):
+            events.put_nowait(sse_event("page", {**page, "pages_done": pages_done, "page_count": page_count}))
+
+    def on_stage(stage: str):
+        events.put_nowait(sse_event(stage, {"pages_done": pages_done}))
+
+    def on_question(question: Dict):
+        events.put_nowait(sse_event("question", question))
+
+    async def run():
+        trace = RequestTrace()
+        current_trace.set(trace)
         try:
-            shutil.rmtree(temp_dir)
-        except PermissionError:
-            # Log the error but don't crash
-            print(f"Warning: Could not delete temporary directory {temp_dir} - it will be cleaned up later")
+            grading_result = await grade_paper(
+                student["path"], answer_key_text, on_pages, on_stage, on_question, grading_mode,
+                document_id=student["document_id"],
+            )
+            if include_timings:
+                grading_result["timings"] = trace.summary()
+            result = GradingResponse(**grading_result).model_dump()
+            events.put_nowait(sse_event("result", result))
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            events.put_nowait(sse_event("error", {"detail": detail}))
+        finally:
+            events.put_nowait(None)
 
+    async def stream():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
 
-@app.post("/generate-report")
-async def generate_pdf_report(grading_results: GradingResults):
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/answer-keys", response_model=AnswerKey)
+async def upload_answer_key(answer_key_pdf: UploadFile = File(...)):
+    stored = await store_pdf(answer_key_pdf)
+    answer_key = await compile_answer_key(stored["path"], answer_key_pdf.filename, stored["document_id"])
+    return answer_key_summary(answer_key)
+
+
+@app.get("/answer-keys/{answer_key_id}", response_model=AnswerKey)
+async def get_answer_key(answer_key_id: str):
+    answer_key = await run_in_threadpool(answer_key_store.load, answer_key_id)
+    if answer_key is None:
+        raise HTTPException(status_code=404, detail=f"Answer key {answer_key_id} not found")
+    return answer_key_summary(answer_key)
+
+
+@app.delete("/answer-keys/{answer_key_id}")
+async def delete_answer_key(answer_key_id: str):
+    if not await run_in_threadpool(answer_key_store.delete, answer_key_id):
+        raise HTTPException(status_code=404, detail=f"Answer key {answer_key_id} not found")
+    return {"deleted": answer_key_id}
+
+
+def extract_pdfs_from_zip(zip_path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    # Each PDF in the archive goes to the upload store like a direct upload;
+    # the declared size is checked before a member is decompressed
+    students = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.infolist():
+            name = os.path.basename(member.filename)
+            if member.is_dir() or member.filename.startswith("__MACOSX/"):
+                continue
+            if not name.lower().endswith(".pdf"):
+                continue
+            with archive.open(member) as source:
+                students.append((name, store_pdf_file(source, name, member.file_size)))
+    return students
+
+def batch_job_status(job: Dict[str, Any]) -> BatchJobStatus:
+    statuses = [student["status"] for student in job["students"]]
+    completed = statuses.count("completed")
+    failed = statuses.count("failed")
+    if any(status in ACTIVE_PAPER_STATUSES for status in statuses):
+        status = "queued" if all(status == "queued" for status in statuses) else "running"
+    elif failed == 0:
+        status = "completed"
+    elif completed == 0:
+        status = "failed"
+    else:
+        status = "completed_with_errors"
+    return BatchJobStatus(
+        **job,
+        status=status,
+        total=len(statuses),
+        completed=completed,
+        failed=failed,
+    )
+
+class JobWorker:
+    # Grades papers from the job store, up to `concurrency` at a time. Any
+    # number of workers, in the API process or in `python worker.py`
+    # processes, can share one store. Every page extraction and question
+    # grade is written back as soon as it arrives, so a paper picked up
+    # after a crash or restart only pays for the calls that were missing.
+    # Each process rate-limits its own Groq calls, so with several workers
+    # EVALO_GROQ_RATE_LIMITS should be set to each worker's share.
+
+    def __init__(self, store: JobStore, concurrency: int):
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: Dict[Tuple[str, int], asyncio.Task] = {}
+        self._wake: Optional[asyncio.Event] = None
+
+    def notify(self):
+        # Called when new papers are queued, to claim them without waiting
+        # for the next poll
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        renewed_at = time.monotonic()
+        try:
+            while True:
+                self._wake.clear()
+                free = self.concurrency - len(self._tasks)
+                if free > 0:
+                    for paper in await run_in_threadpool(self.store.fail_abandoned):
+                        await self._clean_up(paper["job_id"], paper["pdf_path"], paper["job_done"])
+                    papers = await run_in_threadpool(
+                        self.store.claim, self.worker_id, free, JOB_LEASE_SECONDS
+                    )
+                    for paper in papers:
+                        key = (paper["job_id"], paper["student_id"])
+                        task = asyncio.create_task(self._grade(paper))
+                        task.add_done_callback(lambda _, key=key: self._done(key))
+                        self._tasks[key] = task
+                if self._tasks and time.monotonic() - renewed_at > JOB_LEASE_SECONDS / 3:
+                    await run_in_threadpool(self.store.renew, self.worker_id, JOB_LEASE_SECONDS)
+                    renewed_at = time.monotonic()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await run_in_threadpool(self.store.release, self.worker_id)
+
+    def _done(self, key: Tuple[str, int]):
+        self._tasks.pop(key, None)
+        self._wake.set()
+
+    async def _grade(self, paper: Dict[str, Any]):
+        # Batch work yields to interactive single-paper requests at the scheduler
+        request_priority.set(PRIORITY_BATCH)
+        job_id, student_id = paper["job_id"], paper["student_id"]
+        writes: List[asyncio.Future] = []
+
+        def persist(func, *args):
+            writes.append(asyncio.ensure_future(run_in_threadpool(func, job_id, student_id, *args)))
+
+        def on_pages(pages: List[Dict], page_count: int):
+            persist(self.store.save_pages, pages, page_count)
+
+        def on_stage(stage: str):
+            persist(self.store.set_status, stage)
+
+        def on_question(question: Dict):
+            persist(self.store.save_question, question)
+
+        result, error = None, None
+        try:
+            done_pages, done_questions = await run_in_threadpool(
+                self.store.load_progress, job_id, student_id
+            )
+            answer_key_text = await load_answer_key_text(paper["answer_key_id"])
+            document_id = await run_in_threadpool(sha256_file, paper["pdf_path"])
+            grading_result = await grade_paper(
+                paper["pdf_path"],
+                answer_key_text,
+                on_pages,
+                on_stage,
+                on_question,
+                paper["grading_mode"],
+                done_pages,
+                done_questions,
+                document_id,
+            )
+            result = GradingResponse(**grading_result).model_dump()
+        except asyncio.CancelledError:
+            await asyncio.gather(*writes, return_exceptions=True)
+            raise
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+        await asyncio.gather(*writes, return_exceptions=True)
+
+        owned, job_done = await run_in_threadpool(
+            self.store.finish, job_id, student_id, self.worker_id, result, error
+        )
+        # A worker whose lease ran out leaves the files to the worker that
+        # took the paper over
+        if owned:
+            await self._clean_up(job_id, paper["pdf_path"], job_done)
+
+    async def _clean_up(self, job_id: str, pdf_path: str, job_done: bool):
+        await run_in_threadpool(discard_files, [pdf_path])
+        if job_done:
+            work_dir = await run_in_threadpool(self.store.work_dir, job_id)
+            if work_dir:
+                await run_in_threadpool(shutil.rmtree, work_dir, True)
+
+# The API process's own worker, when EVALO_EMBEDDED_WORKER is on
+job_worker: Optional[JobWorker] = None
+
+
+@app.post("/batch-jobs", response_model=BatchJobStatus, status_code=202)
+async def create_batch_job(
+    student_pdfs: Optional[List[UploadFile]] = File(None),
+    students_zip: Optional[UploadFile] = File(None),
+    answer_key_pdf: Optional[UploadFile] = File(None),
+    answer_key_id: Optional[str] = Form(None),
+    grading_mode: str = Form(GRADING_MODE)
+):
+    validate_grading_mode(grading_mode)
+    if (answer_key_pdf is None) == (answer_key_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide exactly one of answer_key_pdf or answer_key_id",
+        )
+    if not student_pdfs and students_zip is None:
+        raise HTTPException(status_code=400, detail="Provide student_pdfs or students_zip")
+
+    # The work directory outlives this request and this process; the worker
+    # that finishes the job's last paper removes it
+    job_id = uuid.uuid4().hex
+    work_dir = os.path.abspath(os.path.join(JOBS_DIR, job_id))
+    await run_in_threadpool(os.makedirs, work_dir, exist_ok=True)
     try:
-        # Create a buffer for the PDF
-        buffer = io.BytesIO()
-        
-        # Create the PDF document
-        doc = SimpleDocTemplate(
-            buffer,
-            pagesize=letter,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
+        stored_pdfs = []
+        for upload in student_pdfs or []:
+            stored_pdfs.append((os.path.basename(upload.filename or "upload.pdf"), await store_pdf(upload)))
+
+        if students_zip is not None:
+            zip_path = os.path.join(work_dir, "students.zip")
+            await run_in_threadpool(save_upload, students_zip, zip_path, MAX_ZIP_UPLOAD_BYTES)
+            try:
+                for name, stored in await run_in_threadpool(extract_pdfs_from_zip, zip_path):
+                    stored_pdfs.append((name, await check_stored_pdf(stored, name)))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail="students_zip is not a valid zip file")
+            await run_in_threadpool(discard_files, [zip_path])
+
+        if not stored_pdfs:
+            raise HTTPException(status_code=400, detail="No student PDFs found in the upload")
+
+        # Each paper gets its own link to the stored file, which its worker
+        # removes once the paper is graded
+        students = []
+        for name, stored in stored_pdfs:
+            pdf_path = os.path.join(work_dir, f"student_{len(students):04d}.pdf")
+            await run_in_threadpool(link_or_copy, stored["path"], pdf_path)
+            students.append((name, pdf_path))
+
+        # Workers load the key by ID, so an uploaded key is compiled first
+        if answer_key_id is not None:
+            await load_answer_key_text(answer_key_id)
+        else:
+            stored = await store_pdf(answer_key_pdf)
+            answer_key = await compile_answer_key(stored["path"], answer_key_pdf.filename, stored["document_id"])
+            answer_key_id = answer_key["answer_key_id"]
+
+        await run_in_threadpool(
+            job_store.create_job, job_id, answer_key_id, grading_mode, work_dir, students
         )
-        
-        # Container for the 'Flowable' objects
-        elements = []
-        
-        # Styles
+    except Exception:
+        await run_in_threadpool(shutil.rmtree, work_dir, True)
+        raise
+
+    if job_worker is not None:
+        job_worker.notify()
+    return batch_job_status(await run_in_threadpool(job_store.load_job, job_id))
+
+
+@app.get("/batch-jobs/{job_id}", response_model=BatchJobStatus)
+async def get_batch_job(job_id: str):
+    job = await run_in_threadpool(job_store.load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch job {job_id} not found")
+    return batch_job_status(job)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "extraction": await run_in_threadpool(extraction_cache.stats),
+        "grading": await run_in_threadpool(grading_cache.stats),
+        "document": await run_in_threadpool(document_cache.stats),
+    }
+
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    return groq_scheduler.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Point-in-time values are sampled on each scrape
+    scheduler = groq_scheduler.stats()
+    metrics.set("evalo_llm_active", scheduler["active"])
+    metrics.set("evalo_llm_queued", scheduler["queued"])
+    for name, cache in (("extraction", extraction_cache), ("grading", grading_cache), ("document", document_cache)):
+        stats = await run_in_threadpool(cache.stats)
+        metrics.set("evalo_cache_lookups_total", stats["hits"], cache=name, result="hit")
+        metrics.set("evalo_cache_lookups_total", stats["misses"], cache=name, result="miss")
+        metrics.set("evalo_cache_entries", stats["entries"], cache=name)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Lower percentage bound of each performance band, best first
+PERFORMANCE_BANDS = ((90.0, "Excellent"), (75.0, "Good"), (60.0, "Satisfactory"), (0.0, "Needs Improvement"))
+
+def performance_band(percentage: float) -> str:
+    for lower_bound, band in PERFORMANCE_BANDS:
+        if percentage >= lower_bound:
+            return band
+    return PERFORMANCE_BANDS[-1][1]
+
+# Report styles are built on first use and then reused by every report the
+# process renders, including in each CPU pool worker
+_report_styles = None
+_report_table_style = None
+
+def report_styles():
+    global _report_styles
+    if _report_styles is None:
+        from reportlab.lib import colors
+        from reportlab.lib.enums import TA_CENTER
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
         styles = getSampleStyleSheet()
-        
+
         # Create a new style with a different name instead of modifying 'Title'
         styles.add(ParagraphStyle(
             name='ReportTitle',  # Different name to avoid conflict
@@ -415,13 +3134,13 @@ async def generate_pdf_report(grading_results: GradingResults):
             alignment=TA_CENTER,
             textColor=colors.purple,
         ))
-        
+
         styles.add(ParagraphStyle(
             name='Heading2Purple',
             parent=styles['Heading2'],
             textColor=colors.purple,
         ))
-        
+
         # Add style for table cells with wrapping text
         styles.add(ParagraphStyle(
             name='TableCell',
@@ -430,7 +3149,7 @@ async def generate_pdf_report(grading_results: GradingResults):
             leading=10,  # Line spacing
             wordWrap='CJK',  # Better word wrapping
         ))
-        
+
         # Add specific style for header cells
         styles.add(ParagraphStyle(
             name='TableHeader',
@@ -441,63 +3160,15 @@ async def generate_pdf_report(grading_results: GradingResults):
             alignment=TA_CENTER,
             wordWrap='CJK',
         ))
-        
-        # Add title
-        elements.append(Paragraph("Exam Results Report", styles['ReportTitle']))
-        elements.append(Spacer(1, 20))
-        
-        # Add overall performance section
-        elements.append(Paragraph("Overall Performance", styles['Heading2Purple']))
-        elements.append(Spacer(1, 10))
-        
-        # Score info
-        elements.append(Paragraph(f"Score: {grading_results.total_score} out of {grading_results.total_possible}", styles['Normal']))
-        elements.append(Paragraph(f"Percentage: {grading_results.percentage:.1f}%", styles['Normal']))
-        
-        # Performance classification
-        performance_text = ""
-        if grading_results.percentage >= 90:
-            performance_text = "Excellent"
-        elif grading_results.percentage >= 75:
-            performance_text = "Good"
-        elif grading_results.percentage >= 60:
-            performance_text = "Satisfactory"
-        else:
-            performance_text = "Needs Improvement"
-            
-        elements.append(Paragraph(f"Performance: {performance_text}", styles['Normal']))
-        elements.append(Spacer(1, 20))
-        
-        # Add question breakdown section
-        elements.append(Paragraph("Question Breakdown", styles['Heading2Purple']))
-        elements.append(Spacer(1, 10))
-        
-        # Create table for questions with proper cell formatting and header paragraphs
-        table_data = [[
-            Paragraph("Question", styles['TableHeader']),
-            Paragraph("Score", styles['TableHeader']),
-            Paragraph("Possible", styles['TableHeader']),
-            Paragraph("Percentage", styles['TableHeader']),
-            Paragraph("Feedback", styles['TableHeader'])
-        ]]
-        
-        for question in grading_results.questions:
-            question_percentage = (question.points_earned / question.points_possible) * 100
-            
-            # Use Paragraph for feedback to enable wrapping
-            table_data.append([
-                Paragraph(str(question.question_number), styles['TableCell']),
-                Paragraph(str(question.points_earned), styles['TableCell']),
-                Paragraph(str(question.points_possible), styles['TableCell']),
-                Paragraph(f"{question_percentage:.0f}%", styles['TableCell']),
-                Paragraph(question.feedback, styles['TableCell'])
-            ])
-        
-        # Adjust column widths - ensure proper spacing
-        table = Table(table_data, colWidths=[60, 50, 60, 70, 230])
-        
-        # Add style to the table
-        table.setStyle(TableStyle([
+        _report_styles = styles
+    return _report_styles
+
+def report_table_style() -> "TableStyle":
+    global _report_table_style
+    if _report_table_style is None:
+        from reportlab.lib import colors
+        from reportlab.platypus import TableStyle
+        _report_table_style = TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.purple),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
             ('ALIGN', (0, 1), (3, -1), 'CENTER'),
@@ -507,29 +3178,107 @@ async def generate_pdf_report(grading_results: GradingResults):
             ('RIGHTPADDING', (0, 0), (-1, -1), 6),
             ('TOPPADDING', (0, 0), (-1, -1), 6),
             ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ]))
-        
-        elements.append(table)
-        elements.append(Spacer(1, 20))
-        
-        # Add detailed feedback section
-        elements.append(Paragraph("Detailed Feedback", styles['Heading2Purple']))
+        ])
+    return _report_table_style
+
+def build_report_pdf(data: Dict[str, Any]) -> bytes:
+    # Runs in the CPU process pool, so it takes GradingResults as a dict
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+    grading_results = GradingResults(**data)
+
+    # Create a buffer for the PDF
+    buffer = io.BytesIO()
+
+    # Create the PDF document
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        rightMargin=72,
+        leftMargin=72,
+        topMargin=72,
+        bottomMargin=72
+    )
+
+    # Container for the 'Flowable' objects
+    elements = []
+
+    styles = report_styles()
+
+    # Add title
+    elements.append(Paragraph("Exam Results Report", styles['ReportTitle']))
+    elements.append(Spacer(1, 20))
+
+    # Add overall performance section
+    elements.append(Paragraph("Overall Performance", styles['Heading2Purple']))
+    elements.append(Spacer(1, 10))
+
+    # Score info
+    elements.append(Paragraph(f"Score: {grading_results.total_score} out of {grading_results.total_possible}", styles['Normal']))
+    elements.append(Paragraph(f"Percentage: {grading_results.percentage:.1f}%", styles['Normal']))
+
+    # Performance classification
+    performance_text = performance_band(grading_results.percentage)
+
+    elements.append(Paragraph(f"Performance: {performance_text}", styles['Normal']))
+    elements.append(Spacer(1, 20))
+
+    # Add question breakdown section
+    elements.append(Paragraph("Question Breakdown", styles['Heading2Purple']))
+    elements.append(Spacer(1, 10))
+
+    # Create table for questions with proper cell formatting and header paragraphs
+    table_data = [[
+        Paragraph("Question", styles['TableHeader']),
+        Paragraph("Score", styles['TableHeader']),
+        Paragraph("Possible", styles['TableHeader']),
+        Paragraph("Percentage", styles['TableHeader']),
+        Paragraph("Feedback", styles['TableHeader'])
+    ]]
+
+    for question in grading_results.questions:
+        question_percentage = (question.points_earned / question.points_possible) * 100
+
+        # Use Paragraph for feedback to enable wrapping
+        table_data.append([
+            Paragraph(str(question.question_number), styles['TableCell']),
+            Paragraph(str(question.points_earned), styles['TableCell']),
+            Paragraph(str(question.points_possible), styles['TableCell']),
+            Paragraph(f"{question_percentage:.0f}%", styles['TableCell']),
+            Paragraph(question.feedback, styles['TableCell'])
+        ])
+
+    # Adjust column widths - ensure proper spacing
+    table = Table(table_data, colWidths=[60, 50, 60, 70, 230])
+
+    table.setStyle(report_table_style())
+
+    elements.append(table)
+    elements.append(Spacer(1, 20))
+
+    # Add detailed feedback section
+    elements.append(Paragraph("Detailed Feedback", styles['Heading2Purple']))
+    elements.append(Spacer(1, 10))
+
+    for question in grading_results.questions:
+        elements.append(Paragraph(f"Question {question.question_number}:", styles['Heading3']))
+        elements.append(Paragraph(question.feedback, styles['Normal']))
         elements.append(Spacer(1, 10))
+
+    # Build the PDF
+    doc.build(elements)
+
+    return buffer.getvalue()
+
+
+@app.post("/generate-report")
+async def generate_pdf_report(grading_results: GradingResults):
+    try:
+        with track_stage("report"):
+            pdf = await run_in_cpu_pool(build_report_pdf, grading_results.model_dump())
         
-        for question in grading_results.questions:
-            elements.append(Paragraph(f"Question {question.question_number}:", styles['Heading3']))
-            elements.append(Paragraph(question.feedback, styles['Normal']))
-            elements.append(Spacer(1, 10))
-        
-        # Build the PDF
-        doc.build(elements)
-        
-        # Move the buffer position to the beginning
-        buffer.seek(0)
-        
-        # Return the PDF as a streaming response
-        return StreamingResponse(
-            buffer, 
+        return Response(
+            content=pdf,
             media_type="application/pdf",
             headers={
                 "Content-Disposition": "attachment; filename=exam-results-report.pdf"
@@ -538,7 +3287,277 @@ async def generate_pdf_report(grading_results: GradingResults):
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating PDF report: {str(e)}")
+
+
+class ZipStreamSink(io.RawIOBase):
+    # Write-only, unseekable target for zipfile. zipfile then writes each
+    # member's sizes after its data, so members can be sent as soon as they
+    # are written; drain() hands over the bytes written so far.
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def report_filename(position: int, student_name: Optional[str]) -> str:
+    name = re.sub(r"[^\w.-]+", "_", os.path.splitext(student_name or "")[0]).strip("._")
+    return f"{position:03d}-{name or 'student'}"
+
+async def render_reports(reports: List[Dict[str, Any]]):
+    # Yields (index, pdf bytes or exception) in completion order. At most
+    # REPORTS_IN_FLIGHT reports are rendering or waiting to be sent, so
+    # memory does not grow with the number of reports.
+    pending: Dict[asyncio.Future, int] = {}
+    queued = iter(enumerate(reports))
+    try:
+        while True:
+            for index, report in queued:
+                future = asyncio.ensure_future(run_in_cpu_pool(build_report_pdf, report))
+                pending[future] = index
+                if len(pending) >= REPORTS_IN_FLIGHT:
+                    break
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                yield index, future.exception() or future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def load_batch_job_results(job_id: str) -> List[Dict[str, Any]]:
+    job = await run_in_threadpool(job_store.load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch job {job_id} not found")
+    results = [
+        {**student["result"], "student_name": student["filename"]}
+        for student in job["students"]
+        if student["result"] is not None
+    ]
+    if not results:
+        raise HTTPException(status_code=409, detail="The batch job has no graded papers yet")
+    return results
+
+@app.post("/generate-reports")
+async def generate_pdf_reports(request: BulkReportRequest):
+    # One report per student, streamed back as a ZIP in the order they
+    # finish rendering, followed by a summary.csv of every student's score.
+    # Reports come either from the request or from a batch job's results.
+    if (request.batch_job_id is None) == (not request.reports):
+        raise HTTPException(status_code=400, detail="Provide exactly one of reports or batch_job_id")
+
+    if request.batch_job_id is not None:
+        reports = await load_batch_job_results(request.batch_job_id)
+    else:
+        reports = [report.model_dump() for report in request.reports]
+
+    async def stream():
+        sink = ZipStreamSink()
+        summary = io.StringIO()
+        summary_writer = csv.writer(summary)
+        summary_writer.writerow(["report", "student", "total_score", "total_possible", "percentage"])
+        # PDFs barely compress, so they are stored as they are
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+            with track_stage("report_bulk"):
+                async for index, pdf in render_reports(reports):
+                    report = reports[index]
+                    filename = report_filename(index + 1, report.get("student_name"))
+                    if isinstance(pdf, Exception):
+                        archive.writestr(f"{filename}.error.txt", f"Error generating PDF report: {pdf}")
+                    else:
+                        archive.writestr(f"{filename}.pdf", pdf)
+                    summary_writer.writerow([
+                        filename,
+                        report.get("student_name") or "",
+                        report["total_score"],
+                        report["total_possible"],
+                        report["percentage"],
+                    ])
+                    yield sink.drain()
+            archive.writestr("summary.csv", summary.getvalue())
+        yield sink.drain()
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=exam-results-reports.zip"},
+    )
     
+# Share of the class on each side used for the discrimination index
+DISCRIMINATION_GROUP = 0.27
+# Students whose robust z-score of their percentage exceeds this are outliers
+OUTLIER_Z = 3.5
+
+def build_score_matrix(results: List[Dict[str, Any]]) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    # Returns question numbers, points possible per question and a students
+    # x questions matrix of points earned. Questions are the union over all
+    # results; a student's missing question is NaN.
+    import numpy as np
+    numbers, earned, possible, per_student = [], [], [], []
+    for result in results:
+        questions = result["questions"]
+        per_student.append(len(questions))
+        for question in questions:
+            numbers.append(question["question_number"])
+            earned.append(question["points_earned"])
+            possible.append(question["points_possible"])
+
+    question_numbers, cols = np.unique(np.array(numbers, dtype=np.int64), return_inverse=True)
+    rows = np.repeat(np.arange(len(results)), per_student)
+    scores = np.full((len(results), len(question_numbers)), np.nan, dtype=np.float32)
+    scores[rows, cols] = np.array(earned, dtype=np.float32)
+    points_possible = np.zeros(len(question_numbers), dtype=np.float32)
+    np.maximum.at(points_possible, cols, np.array(possible, dtype=np.float32))
+    return question_numbers, points_possible, scores
+
+def optional_float(value: float) -> Optional[float]:
+    import numpy as np
+    return None if not np.isfinite(value) else round(float(value), 4)
+
+def column_correlation(a: "np.ndarray", b: "np.ndarray") -> "np.ndarray":
+    # Pearson correlation of each column of a with the same column of b
+    import numpy as np
+    a = a - a.mean(axis=0)
+    b = b - b.mean(axis=0)
+    denominator = np.sqrt((a * a).sum(axis=0) * (b * b).sum(axis=0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, (a * b).sum(axis=0) / denominator, np.nan)
+
+def compute_class_analytics(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    import numpy as np
+    question_numbers, points_possible, scores = build_score_matrix(results)
+    students, questions = scores.shape
+    answered = ~np.isnan(scores)
+    # Unanswered questions score nothing towards a student's total
+    filled = np.where(answered, scores, 0.0).astype(np.float64)
+    percentages = np.array([result["percentage"] for result in results], dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = filled / points_possible
+    fractions[:, points_possible <= 0] = np.nan
+
+    totals = filled.sum(axis=1)
+    item_total = column_correlation(filled, totals[:, None] - filled)
+
+    group = max(1, int(round(students * DISCRIMINATION_GROUP)))
+    order = np.argsort(totals, kind="stable")
+    if students >= 2:
+        discrimination = (
+            np.nanmean(fractions[order[-group:]], axis=0) - np.nanmean(fractions[order[:group]], axis=0)
+        ) if questions else np.array([])
+    else:
+        discrimination = np.full(questions, np.nan)
+
+    reliability = np.nan
+    if questions > 1 and students > 1:
+        item_variance = filled.var(axis=0, ddof=1).sum()
+        total_variance = totals.var(ddof=1)
+        if total_variance > 0:
+            reliability = questions / (questions - 1) * (1 - item_variance / total_variance)
+
+    with np.errstate(invalid="ignore"):
+        masked = np.where(answered, scores, np.nan).astype(np.float64)
+        means = np.nanmean(masked, axis=0) if students else np.full(questions, np.nan)
+        stds = np.nanstd(masked, axis=0) if students else np.full(questions, np.nan)
+        medians = np.nanmedian(masked, axis=0) if students else np.full(questions, np.nan)
+        minimums = np.nanmin(np.where(answered, masked, np.inf), axis=0, initial=np.inf)
+        maximums = np.nanmax(np.where(answered, masked, -np.inf), axis=0, initial=-np.inf)
+    answered_counts = answered.sum(axis=0)
+    full_marks = (answered & (scores >= points_possible) & (points_possible > 0)).sum(axis=0)
+    zeros = (answered & (scores <= 0)).sum(axis=0)
+
+    question_stats = []
+    for column, number in enumerate(question_numbers.tolist()):
+        count = int(answered_counts[column])
+        question_stats.append({
+            "question_number": number,
+            "points_possible": float(points_possible[column]),
+            "answered": count,
+            "mean": optional_float(means[column]) or 0.0,
+            "std": optional_float(stds[column]) or 0.0,
+            "median": optional_float(medians[column]) or 0.0,
+            "min": optional_float(minimums[column]) or 0.0,
+            "max": optional_float(maximums[column]) or 0.0,
+            "difficulty": optional_float(means[column] / points_possible[column]) or 0.0
+            if points_possible[column] > 0 else 0.0,
+            "full_marks_rate": round(full_marks[column] / count, 4) if count else 0.0,
+            "zero_rate": round(zeros[column] / count, 4) if count else 0.0,
+            "item_total_correlation": optional_float(item_total[column]),
+            "discrimination_index": optional_float(discrimination[column]),
+        })
+
+    # Modified z-score (median and MAD), which a few extreme scores cannot
+    # drag around the way they would a mean and standard deviation
+    outliers = []
+    if students:
+        median = np.median(percentages)
+        mad = np.median(np.abs(percentages - median))
+        if mad > 0:
+            robust_z = 0.6745 * (percentages - median) / mad
+            for index in np.flatnonzero(np.abs(robust_z) > OUTLIER_Z).tolist():
+                outliers.append({
+                    "student_index": index,
+                    "student_name": results[index].get("student_name"),
+                    "percentage": float(percentages[index]),
+                    "robust_z": round(float(robust_z[index]), 3),
+                })
+
+    edges = np.linspace(0.0, 100.0, 11)
+    counts, _ = np.histogram(np.clip(percentages, 0.0, 100.0), bins=edges)
+    # PERFORMANCE_BANDS is sorted best first; searched in ascending order, a
+    # percentage below every bound falls in the lowest band, as in
+    # performance_band
+    ascending_bounds = np.array([lower_bound for lower_bound, _ in reversed(PERFORMANCE_BANDS)])
+    position = np.searchsorted(ascending_bounds, percentages, side="right") - 1
+    band_index = len(PERFORMANCE_BANDS) - 1 - np.clip(position, 0, None)
+    band_counts = np.bincount(band_index, minlength=len(PERFORMANCE_BANDS))
+
+    return {
+        "students": students,
+        "questions": questions,
+        "reliability": optional_float(reliability),
+        "percentage": {
+            "mean": round(float(percentages.mean()), 4) if students else 0.0,
+            "std": round(float(percentages.std()), 4) if students else 0.0,
+            "min": float(percentages.min()) if students else 0.0,
+            "max": float(percentages.max()) if students else 0.0,
+            "quartiles": np.percentile(percentages, [25, 50, 75]).round(4).tolist() if students else [],
+            "histogram_edges": edges.tolist(),
+            "histogram_counts": counts.tolist(),
+            "bands": {
+                band: int(count) for (_, band), count in zip(PERFORMANCE_BANDS, band_counts.tolist())
+            },
+        },
+        "question_stats": question_stats,
+        "outliers": outliers,
+    }
+
+
+@app.post("/analytics", response_model=ClassAnalytics)
+async def class_analytics(request: AnalyticsRequest):
+    # Class-level statistics over many students' GradingResults, or over a
+    # batch job's graded papers
+    if (request.batch_job_id is None) == (not request.results):
+        raise HTTPException(status_code=400, detail="Provide exactly one of results or batch_job_id")
+    if request.batch_job_id is not None:
+        results = await load_batch_job_results(request.batch_job_id)
+    else:
+        results = [result.model_dump() for result in request.results]
+    with track_stage("analytics"):
+        return await run_in_threadpool(compute_class_analytics, results)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# server.py reads its configuration at import time; keep every store in a
+# scratch directory and make sure no test can reach the real Groq API
+_scratch = tempfile.mkdtemp(prefix="evalo_tests_")
+os.environ["GROQ_API_KEY"] = "test"
+os.environ["GROQ_BASE_URL"] = "http://127.0.0.1:9"
+os.environ["EVALO_CACHE_PATH"] = ""
+os.environ["EVALO_DATA_PATH"] = os.path.join(_scratch, "data.sqlite3")
+os.environ["EVALO_JOBS_DIR"] = os.path.join(_scratch, "jobs")
+os.environ["EVALO_UPLOADS_DIR"] = os.path.join(_scratch, "uploads")
+os.environ["EVALO_WARM_UP"] = "0"
+# Small enough that the request size limits can be tested quickly
+os.environ["EVALO_MAX_UPLOAD_MB"] = "1"
+os.environ["EVALO_EMBEDDED_WORKER"] = "0"
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_scratch, ignore_errors=True)
@@ -0,0 +1,76 @@
+import pytest
+
+import server
+
+
+def result(percentage, *earned, possible=(5.0, 5.0), name=None):
+    questions = [
+        {"question_number": number, "points_earned": points, "points_possible": possible[number - 1]}
+        for number, points in enumerate(earned, start=1)
+        if points is not None
+    ]
+    return {
+        "student_name": name,
+        "percentage": percentage,
+        "total_score": sum(q["points_earned"] for q in questions),
+        "total_possible": sum(possible),
+        "questions": questions,
+    }
+
+
+def test_question_statistics():
+    analytics = server.compute_class_analytics([
+        result(100.0, 5.0, 5.0),
+        result(50.0, 5.0, 0.0),
+        result(10.0, 1.0, None),
+    ])
+    assert analytics["students"] == 3
+    assert analytics["questions"] == 2
+    first, second = analytics["question_stats"]
+    assert first["answered"] == 3
+    assert first["mean"] == pytest.approx(11 / 3, abs=1e-4)
+    assert first["difficulty"] == pytest.approx(11 / 15, abs=1e-4)
+    assert first["full_marks_rate"] == pytest.approx(2 / 3, abs=1e-4)
+    # An unanswered question does not count towards its mean
+    assert second["answered"] == 2
+    assert second["mean"] == 2.5
+    assert second["zero_rate"] == 0.5
+
+
+def test_bands_match_performance_band():
+    percentages = [-5.0, 0.0, 59.9, 60.0, 75.0, 89.9, 90.0, 100.0]
+    analytics = server.compute_class_analytics([result(p, 1.0, 1.0) for p in percentages])
+    expected = {band: 0 for _, band in server.PERFORMANCE_BANDS}
+    for percentage in percentages:
+        expected[server.performance_band(percentage)] += 1
+    assert analytics["percentage"]["bands"] == expected
+
+
+def test_histogram_clips_to_the_percentage_range():
+    analytics = server.compute_class_analytics([result(-10.0, 0.0, 0.0), result(120.0, 5.0, 5.0)])
+    counts = analytics["percentage"]["histogram_counts"]
+    assert counts[0] == 1 and counts[-1] == 1 and sum(counts) == 2
+
+
+def test_outliers():
+    results = [result(70.0 + i % 3, 3.0, 4.0, name=f"s{i}") for i in range(20)]
+    results.append(result(5.0, 0.0, 0.0, name="low"))
+    outliers = server.compute_class_analytics(results)["outliers"]
+    assert [o["student_name"] for o in outliers] == ["low"]
+
+
+def test_discrimination_and_reliability():
+    # Question 1 separates strong and weak students, question 2 does not
+    results = [result(90.0, 5.0, 4.0)] * 5 + [result(40.0, 0.0, 4.0)] * 5
+    analytics = server.compute_class_analytics(results)
+    first, second = analytics["question_stats"]
+    assert first["discrimination_index"] == 1.0
+    assert second["discrimination_index"] == 0.0
+    assert second["item_total_correlation"] is None
+
+
+def test_single_student_has_no_spread_statistics():
+    analytics = server.compute_class_analytics([result(80.0, 4.0, 4.0)])
+    assert analytics["reliability"] is None
+    assert analytics["question_stats"][0]["discrimination_index"] is None
+    assert analytics["outliers"] == []
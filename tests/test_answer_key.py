@@ -0,0 +1,38 @@
+import server
+
+
+ANSWER_KEY = """Physics midterm
+
+Question 1 (4 marks)
+Define forward bias.
+
+Q2: 6 marks
+Draw the I-V curve.
+
+Q3) 5 points
+Explain the threshold voltage.
+"""
+
+
+def test_split_answer_key():
+    rubric = server.split_answer_key(ANSWER_KEY)
+    assert [entry["question_number"] for entry in rubric] == [1, 2, 3]
+    assert [entry["points_possible"] for entry in rubric] == [4.0, 6.0, 5.0]
+    assert rubric[1]["text"] == "Q2: 6 marks\nDraw the I-V curve."
+
+
+def test_split_answer_key_without_headers():
+    assert server.split_answer_key("Award marks for a clear explanation.") == []
+
+
+def test_sub_parts_are_one_question():
+    rubric = server.split_answer_key("Q1 a) (2 marks)\nfoo\nQ1 b) (3 marks)\nbar\nQ2 (4 marks)\nbaz")
+    assert [entry["question_number"] for entry in rubric] == [1, 2]
+    assert rubric[0]["points_possible"] == 5.0
+    assert "foo" in rubric[0]["text"] and "bar" in rubric[0]["text"]
+
+
+def test_question_total_is_not_added_to_its_parts():
+    rubric = server.split_answer_key("Question 1 (5 marks)\nQ1 a) 2 marks\nQ1 b) 3 marks")
+    assert len(rubric) == 1
+    assert rubric[0]["points_possible"] == 5.0
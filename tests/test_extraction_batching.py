@@ -0,0 +1,43 @@
+import asyncio
+
+import server
+
+
+def scanned_pdf(path, pages):
+    from PIL import Image
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    width, height = A4
+    pdf = canvas.Canvas(str(path), pagesize=A4)
+    for _ in range(pages):
+        image = Image.new("L", (620, 877), 250)
+        image.paste(20, (60, 60, 560, 400))
+        pdf.drawImage(ImageReader(image), 0, 0, width, height)
+        pdf.showPage()
+    pdf.save()
+    return str(path)
+
+
+def test_first_page_is_sent_alone_then_pages_are_batched(tmp_path, monkeypatch):
+    batches = []
+
+    async def run_inline(func, *args):
+        return func(*args)
+
+    async def extract(images, prompt, num_images, **kwargs):
+        batches.append(num_images)
+        return [
+            {"page_number": n, "text": "answer", "visual_description": "", "confidence_text": 0.9}
+            for n in range(1, num_images + 1)
+        ]
+
+    monkeypatch.setattr(server, "run_in_cpu_pool", run_inline)
+    monkeypatch.setattr(server, "extract_text_and_visuals_async", extract)
+    path = scanned_pdf(tmp_path / "scan.pdf", 10)
+    text, confidence, reports = asyncio.run(
+        server.process_pdf_to_text_async(path, batch_size=4, concurrency=2)
+    )
+    assert batches == [1, 4, 4, 1]
+    assert sorted(confidence) == list(range(1, 11))
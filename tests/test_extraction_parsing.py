@@ -0,0 +1,99 @@
+import json
+
+import server
+
+
+def page(number, text="Q1) answer", **extra):
+    return {
+        "page_number": number,
+        "text": text,
+        "visual_description": "",
+        "confidence_text": 0.9,
+        "confidence_visual": 0.0,
+        **extra,
+    }
+
+
+def feed_in_chunks(text, size):
+    parser = server.PageObjectParser()
+    pages = []
+    for start in range(0, len(text), size):
+        pages += parser.feed(text[start:start + size])
+    return pages
+
+
+def test_bare_array():
+    text = json.dumps([page(1), page(2)])
+    assert [p["page_number"] for p in server.parse_extraction_response(text)] == [1, 2]
+
+
+def test_chunked_input_gives_the_same_pages_as_one_piece():
+    text = json.dumps([page(1, 'a "quoted" {brace}'), page(2, "back\\slash }"), page(3)])
+    whole = server.parse_extraction_response(text)
+    for size in (1, 2, 7, 64):
+        assert feed_in_chunks(text, size) == whole
+    assert [p["text"] for p in whole] == ['a "quoted" {brace}', "back\\slash }", "Q1) answer"]
+
+
+def test_page_is_returned_as_soon_as_it_closes():
+    parser = server.PageObjectParser()
+    first = json.dumps(page(1))
+    assert parser.feed("[" + first[:-1]) == []
+    assert [p["page_number"] for p in parser.feed(first[-1] + ", ")] == [1]
+    assert [p["page_number"] for p in parser.feed(json.dumps(page(2)) + "]")] == [2]
+
+
+def test_wrapped_array_and_surrounding_prose():
+    text = "Here are the pages:\n" + json.dumps({"extractions": [page(1), page(2)]}) + "\nDone."
+    assert [p["page_number"] for p in server.parse_extraction_response(text)] == [1, 2]
+
+
+def test_malformed_page_does_not_lose_its_neighbours():
+    broken = json.dumps(page(2)).replace('", "', '" "', 1)
+    text = "[" + ", ".join([json.dumps(page(1)), broken, json.dumps(page(3))]) + "]"
+    assert [p["page_number"] for p in server.parse_extraction_response(text)] == [1, 3]
+
+
+def test_page_with_a_nested_object():
+    text = json.dumps([page(1, bbox={"x": 0, "y": 10}), page(2)])
+    pages = server.parse_extraction_response(text)
+    assert [p["page_number"] for p in pages] == [1, 2]
+    assert pages[0]["bbox"] == {"x": 0, "y": 10}
+
+
+def test_objects_without_a_page_number_are_skipped():
+    text = json.dumps([{"text": "no number"}, page(4, confidence_text="high"), page(5)])
+    assert [p["page_number"] for p in server.parse_extraction_response(text)] == [5]
+
+
+def test_merge_maps_batch_positions_to_requested_pages():
+    found = {}
+    server.merge_page_objects(found, [page(1, "first"), page(2, "second")], [3, 7])
+    assert sorted(found) == [3, 7]
+    assert found[7][0]["text"] == "second"
+    assert found[7][0]["page_number"] == 7
+
+
+def test_merge_keeps_pages_already_received():
+    found = {3: [page(3, "original")]}
+    server.merge_page_objects(found, [page(1, "retry"), page(2, "new")], [3, 4])
+    assert found[3][0]["text"] == "original"
+    assert found[4][0]["text"] == "new"
+
+
+def test_merge_drops_positions_outside_the_request():
+    found = {}
+    server.merge_page_objects(found, [page(5)], [3, 4])
+    assert found == {}
+
+
+def test_merge_single_page_request_takes_any_numbering():
+    found = {}
+    server.merge_page_objects(found, [page(8, "only")], [2])
+    assert found[2][0]["text"] == "only"
+
+
+def test_merge_keeps_several_objects_for_one_page():
+    found = {}
+    server.merge_page_objects(found, [page(1, "top"), page(1, "bottom")], [6])
+    assert [item["text"] for item in found[6]] == ["top", "bottom"]
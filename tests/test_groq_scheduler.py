@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from groq import BadRequestError, RateLimitError
+
+import server
+
+
+def groq_error(error_class, status_code):
+    request = httpx.Request("POST", "http://groq.test/chat/completions")
+    return error_class("error", response=httpx.Response(status_code, request=request), body=None)
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(server, "groq_retry_delay", lambda attempt, error: 0.2)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_waiting_calls_are_granted_in_priority_order():
+    async def scenario():
+        scheduler = server.GroqScheduler(1)
+        order = []
+        running = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def hold():
+            running.set()
+            await finish.wait()
+
+        async def call(name):
+            order.append(name)
+
+        holder = asyncio.create_task(scheduler.submit("model", 10, hold))
+        await running.wait()
+        waiting = [
+            asyncio.create_task(scheduler.submit("model", 10, lambda: call("batch"), server.PRIORITY_BATCH)),
+            asyncio.create_task(scheduler.submit("model", 10, lambda: call("interactive"))),
+        ]
+        await asyncio.sleep(0.05)
+        assert order == [] and scheduler.stats()["queued"] == 2
+        finish.set()
+        await asyncio.gather(holder, *waiting)
+        await scheduler.close()
+        return order
+
+    assert run(scenario()) == ["interactive", "batch"]
+
+
+def test_rate_limited_call_pauses_the_model_and_is_retried():
+    async def scenario():
+        scheduler = server.GroqScheduler(4)
+        attempts = []
+
+        async def limited():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise groq_error(RateLimitError, 429)
+            return "graded"
+
+        first = asyncio.create_task(scheduler.submit("model", 10, limited))
+        await asyncio.sleep(0.05)
+        # The pause holds back other calls to the same model, not only the
+        # one that was rate limited
+        started = time.monotonic()
+        other = await scheduler.submit("model", 10, lambda: asyncio.sleep(0, "other"))
+        waited = time.monotonic() - started
+        result = await first
+        await scheduler.close()
+        return scheduler, attempts, result, other, waited
+
+    scheduler, attempts, result, other, waited = run(scenario())
+    assert (result, other) == ("graded", "other")
+    assert attempts[1] - attempts[0] >= 0.2
+    assert waited >= 0.1
+    assert (scheduler.retries, scheduler.rate_limited, scheduler.active) == (1, 1, 0)
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    async def scenario():
+        scheduler = server.GroqScheduler(1)
+        calls = []
+
+        async def rejected():
+            calls.append(1)
+            raise groq_error(BadRequestError, 400)
+
+        with pytest.raises(BadRequestError):
+            await scheduler.submit("model", 10, rejected)
+        await scheduler.close()
+        return scheduler, calls
+
+    scheduler, calls = run(scenario())
+    assert len(calls) == 1
+    assert (scheduler.retries, scheduler.active) == (0, 0)
+
+
+def test_cancelled_calls_give_their_slot_back():
+    async def scenario():
+        scheduler = server.GroqScheduler(1)
+        running = asyncio.Event()
+
+        async def hold():
+            running.set()
+            await asyncio.sleep(60)
+
+        holder = asyncio.create_task(scheduler.submit("model", 10, hold))
+        await running.wait()
+        waiter = asyncio.create_task(scheduler.submit("model", 10, lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0.05)
+        # Cancelled while queued and while running
+        waiter.cancel()
+        holder.cancel()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+        assert scheduler.active == 0
+        result = await asyncio.wait_for(scheduler.submit("model", 10, lambda: asyncio.sleep(0, "sent")), 1)
+        stats = scheduler.stats()
+        await scheduler.close()
+        return result, stats
+
+    result, stats = run(scenario())
+    assert result == "sent"
+    assert (stats["active"], stats["queued"]) == (0, 0)
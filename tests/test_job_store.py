@@ -0,0 +1,83 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = server.JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create_job(
+        "job", "key", "per_question", str(tmp_path), [("a.pdf", "/a.pdf"), ("b.pdf", "/b.pdf")]
+    )
+    yield store
+    store.close()
+
+
+def statuses(store):
+    return [student["status"] for student in store.load_job("job")["students"]]
+
+
+def test_claim_hands_out_each_paper_once(store):
+    first = store.claim("w1", 1, 60)
+    second = store.claim("w2", 5, 60)
+    assert [paper["student_id"] for paper in first] == [0]
+    assert [paper["student_id"] for paper in second] == [1]
+    assert store.claim("w3", 5, 60) == []
+    assert statuses(store) == ["extracting", "extracting"]
+
+
+def test_expired_lease_is_claimed_again(store):
+    store.claim("w1", 1, -1)
+    taken_over = store.claim("w2", 1, 60)
+    assert [paper["student_id"] for paper in taken_over] == [0]
+
+
+def test_finish_by_lease_holder(store):
+    store.claim("w1", 2, 60)
+    store.save_question("job", 0, {"question_number": 1, "points_earned": 1})
+    assert store.finish("job", 0, "w1", {"total_score": 1}) == (True, False)
+    assert store.load_progress("job", 0) == ({}, {})
+    assert store.finish("job", 1, "w1", error="failed") == (True, True)
+    assert statuses(store) == ["completed", "failed"]
+
+
+def test_finish_after_losing_the_lease(store):
+    store.claim("w1", 1, -1)
+    store.claim("w2", 1, 60)
+    store.save_question("job", 0, {"question_number": 1, "points_earned": 1})
+    owned, _ = store.finish("job", 0, "w1", {"total_score": 0})
+    assert not owned
+    # The new owner's progress and status are untouched
+    assert 1 in store.load_progress("job", 0)[1]
+    assert statuses(store)[0] == "extracting"
+    assert store.finish("job", 0, "w2", {"total_score": 1})[0]
+
+
+def test_release_gives_the_claim_back(store):
+    store.claim("w1", 2, 60)
+    store.release("w1")
+    assert len(store.claim("w2", 2, 60)) == 2
+    for _ in range(server.JOB_MAX_ATTEMPTS - 1):
+        store.release("w2")
+        store.claim("w2", 2, 60)
+    assert store.fail_abandoned() == []
+
+
+def test_abandoned_papers_are_failed_and_reported(store):
+    for attempt in range(server.JOB_MAX_ATTEMPTS):
+        assert len(store.claim(f"w{attempt}", 1, -1)) == 1
+    # Out of attempts: not handed out again
+    assert [paper["student_id"] for paper in store.claim("wx", 2, 60)] == [1]
+    abandoned = store.fail_abandoned()
+    assert abandoned == [{"job_id": "job", "pdf_path": "/a.pdf", "job_done": False}]
+    assert statuses(store)[0] == "failed"
+    assert store.fail_abandoned() == []
+
+
+def test_last_abandoned_paper_finishes_the_job(tmp_path):
+    store = server.JobStore(str(tmp_path / "single.sqlite3"))
+    store.create_job("solo", "key", "single", str(tmp_path), [("a.pdf", "/a.pdf")])
+    for attempt in range(server.JOB_MAX_ATTEMPTS):
+        store.claim(f"w{attempt}", 1, -1)
+    assert store.fail_abandoned() == [{"job_id": "solo", "pdf_path": "/a.pdf", "job_done": True}]
+    store.close()
@@ -0,0 +1,61 @@
+import base64
+
+import pytest
+
+import server
+
+
+def render(tmp_path, draw):
+    import pypdfium2 as pdfium
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    path = str(tmp_path / "page.pdf")
+    pdf = canvas.Canvas(path, pagesize=A4)
+    draw(pdf)
+    pdf.showPage()
+    pdf.save()
+    document = pdfium.PdfDocument(path)
+    try:
+        return server.prepare_page_image(document[0])
+    finally:
+        document.close()
+
+
+def test_blank_page_has_no_image(tmp_path):
+    info = render(tmp_path, lambda pdf: None)
+    assert info["image"] is None
+    assert info["payload_bytes"] == 0
+    assert info["raw_bytes"] == info["width"] * info["height"]
+
+
+def test_specks_below_the_ink_ratio_count_as_blank(tmp_path):
+    # A scanner's dust: some ink, but far below BLANK_PAGE_INK_RATIO
+    info = render(tmp_path, lambda pdf: pdf.rect(300, 400, 2, 2, fill=1))
+    assert info["image"] is None
+
+
+def test_light_marks_are_not_ink(tmp_path):
+    def draw(pdf):
+        pdf.setFillGray(0.9)
+        pdf.rect(100, 100, 300, 300, fill=1, stroke=0)
+    assert render(tmp_path, draw)["image"] is None
+
+
+def test_written_page_is_cropped_to_its_ink(tmp_path):
+    def draw(pdf):
+        pdf.setFont("Helvetica", 28)
+        pdf.drawString(150, 500, "x = 2y + 3")
+        pdf.drawString(150, 450, "so y = (x - 3) / 2")
+    info = render(tmp_path, draw)
+    assert info["image"][:2] == b"\xff\xd8"
+    assert info["payload_bytes"] == len(base64.b64encode(info["image"]))
+    full_width = round(595.27 * info["scale"])
+    assert info["width"] < full_width / 2
+    assert info["width"] * info["height"] < info["raw_bytes"]
+
+
+def test_scale_follows_the_pixel_budget():
+    assert server.render_scale_for_budget(600, 800, 480000 * 4) == pytest.approx(2.0)
+    assert server.render_scale_for_budget(600, 800, 1) == server.RENDER_MIN_SCALE
+    assert server.render_scale_for_budget(10, 10, 10 ** 9) == server.RENDER_MAX_SCALE
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import server
+
+TYPED = "The derivative of x squared is two x, by the power rule. " * 8
+
+
+def build_pdf(path, *kinds):
+    from PIL import Image
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    width, height = A4
+    pdf = canvas.Canvas(str(path), pagesize=A4)
+    for kind in kinds:
+        if kind in ("scan", "printed_question"):
+            image = Image.new("L", (620, 877), 250)
+            image.paste(20, (60, 60, 560, 400))
+            pdf.drawImage(ImageReader(image), 0, 0, width, height)
+        if kind in ("typed", "printed_question"):
+            text = pdf.beginText(40, height - 60)
+            for start in range(0, len(TYPED), 80):
+                text.textLine(TYPED[start:start + 80])
+            pdf.drawText(text)
+        pdf.showPage()
+    pdf.save()
+    return str(path)
+
+
+def inspect(path, index, render=True):
+    return server.inspect_and_prepare_pdf_page(path, index, render)
+
+
+def test_typed_page_uses_the_text_layer(tmp_path):
+    path = build_pdf(tmp_path / "typed.pdf", "typed")
+    inspection = inspect(path, 0)
+    assert inspection["route"] == "text_layer"
+    assert "power rule" in inspection["text"]
+    assert "prepared" not in inspection
+
+
+def test_scanned_and_annotated_pages_go_to_the_vision_model(tmp_path):
+    path = build_pdf(tmp_path / "scans.pdf", "scan", "printed_question", "blank")
+    for index in range(3):
+        inspection = inspect(path, index)
+        assert inspection["route"] == "vision"
+        assert inspection["text"] == ""
+        assert "prepared" in inspection
+    # The printed question's text does not outweigh the page-sized image
+    assert inspect(path, 1)["chars"] >= server.TEXT_LAYER_MIN_CHARS
+    assert inspect(path, 1)["image_coverage"] == 1.0
+
+
+def test_render_false_only_inspects(tmp_path):
+    path = build_pdf(tmp_path / "scan.pdf", "scan")
+    inspection = inspect(path, 0, render=False)
+    assert inspection["route"] == "vision"
+    assert "prepared" not in inspection
+
+
+@pytest.fixture
+def cpu_pool_inline(monkeypatch):
+    async def run_inline(func, *args):
+        return func(*args)
+    monkeypatch.setattr(server, "run_in_cpu_pool", run_inline)
+
+
+def test_pages_that_need_no_vision_call(tmp_path, cpu_pool_inline):
+    # Typed, blank and already extracted pages never reach the (unreachable)
+    # Groq API
+    path = build_pdf(tmp_path / "mixed.pdf", "typed", "blank", "scan")
+    resumed = {3: [{"page_number": 3, "text": "from before", "visual_description": "", "confidence_text": 0.9}]}
+    reported = []
+    text, confidence, reports = asyncio.run(server.process_pdf_to_text_async(
+        path, batch_size=4, on_pages=lambda data, count: reported.append(count), done_pages=resumed,
+    ))
+    assert [report["route"] for report in reports] == ["text_layer", "blank", "resumed"]
+    assert "power rule" in text and "from before" in text
+    assert confidence[1] == 1.0
+    assert reported == [3]
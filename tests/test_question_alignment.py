@@ -0,0 +1,36 @@
+import server
+
+
+def test_align_explicit_markers():
+    text = "Name: A\nQ1. Forward bias is...\nmore\nQ2) The curve rises\nQ3 Threshold"
+    segments = server.align_answers_to_questions(text, [1, 2, 3])
+    assert segments == {
+        1: "Q1. Forward bias is...\nmore",
+        2: "Q2) The curve rises",
+        3: "Q3 Threshold",
+    }
+
+
+def test_align_ignores_numbered_steps_when_explicit_markers_exist():
+    text = "Q1 Steps:\n1. connect\n2. measure\nQ2 Answer two"
+    segments = server.align_answers_to_questions(text, [1, 2])
+    assert segments[1] == "Q1 Steps:\n1. connect\n2. measure"
+    assert segments[2] == "Q2 Answer two"
+
+
+def test_align_bare_numbers_only_in_ascending_order():
+    text = "1. first answer\n2. second answer\n1) a step inside the answer\n3. third"
+    segments = server.align_answers_to_questions(text, [1, 2, 3])
+    assert segments[2] == "2. second answer\n1) a step inside the answer"
+    assert segments[3] == "3. third"
+
+
+def test_align_skips_unknown_and_repeated_questions():
+    text = "Q1 one\nQ9 not in the key\nQ1 again\nQ2 two"
+    segments = server.align_answers_to_questions(text, [1, 2])
+    assert segments[1] == "Q1 one\nQ9 not in the key\nQ1 again"
+    assert segments[2] == "Q2 two"
+
+
+def test_align_without_markers():
+    assert server.align_answers_to_questions("Just prose.", [1, 2]) == {}
@@ -0,0 +1,68 @@
+import pytest
+
+import server
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    cache = server.ResultCache(str(tmp_path / "cache.sqlite3"), "results", max_entries=2, ttl_seconds=60)
+    yield cache
+    cache.close()
+
+
+def test_round_trip(cache):
+    cache.set("key", {"pages": [1, 2]})
+    assert cache.get("key") == {"pages": [1, 2]}
+    assert cache.get("other") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_are_misses(cache, clock):
+    cache.set("key", "value")
+    clock.now += 61
+    assert cache.get("key") is None
+    assert cache.evictions == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_reading_does_not_extend_the_ttl(cache, clock):
+    cache.set("key", "value")
+    clock.now += 40
+    assert cache.get("key") == "value"
+    clock.now += 40
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_is_evicted(cache, clock):
+    cache.set("a", 1)
+    clock.now += 1
+    cache.set("b", 2)
+    clock.now += 1
+    assert cache.get("a") == 1
+    clock.now += 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = server.ResultCache("", "results", max_entries=2, ttl_seconds=60)
+    cache.set("key", "value")
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
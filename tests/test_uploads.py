@@ -0,0 +1,91 @@
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = server.UploadStore(str(tmp_path / "uploads.sqlite3"), str(tmp_path / "blobs"), 3600)
+    yield store
+    store.close()
+
+
+def stored_files(store):
+    return sorted(
+        os.path.relpath(os.path.join(directory, name), store.directory)
+        for directory, _, names in os.walk(store.directory)
+        for name in names
+    )
+
+
+def test_put_stores_by_content_hash(store):
+    content = b"%PDF-1.4 one paper"
+    stored = store.put(io.BytesIO(content), 1024)
+    assert stored["document_id"] == hashlib.sha256(content).hexdigest()
+    assert stored["size"] == len(content)
+    assert stored["page_count"] is None
+    assert not stored["reused"]
+    with open(stored["path"], "rb") as f:
+        assert f.read() == content
+
+
+def test_put_reuses_an_existing_blob(store):
+    first = store.put(io.BytesIO(b"same paper"), 1024)
+    store.set_page_count(first["document_id"], 3)
+    second = store.put(io.BytesIO(b"same paper"), 1024)
+    assert second["reused"]
+    assert second["path"] == first["path"]
+    assert second["page_count"] == 3
+    assert stored_files(store) == [os.path.relpath(first["path"], store.directory)]
+
+
+def test_put_over_the_limit_leaves_nothing_behind(store):
+    with pytest.raises(server.UploadTooLarge):
+        store.put(io.BytesIO(b"x" * 2048), 1024)
+    assert stored_files(store) == []
+
+
+def test_discard_removes_the_blob(store):
+    stored = store.put(io.BytesIO(b"discard me"), 1024)
+    store.discard(stored["document_id"])
+    assert not os.path.exists(stored["path"])
+    assert not store.put(io.BytesIO(b"discard me"), 1024)["reused"]
+
+
+def chunked(size, chunk=64 * 1024):
+    # A generator body is sent without a Content-Length
+    for start in range(0, size, chunk):
+        yield b"x" * min(chunk, size - start)
+
+
+MULTIPART = {"content-type": "multipart/form-data; boundary=limit"}
+
+
+def test_chunked_body_over_the_route_limit_is_refused():
+    client = TestClient(server.app)
+    response = client.post("/process-pdfs", content=chunked(server.MAX_REQUEST_BYTES + 1), headers=MULTIPART)
+    assert response.status_code == 413
+    assert str(server.MAX_REQUEST_BYTES) in response.json()["detail"]
+
+
+def test_declared_length_over_the_route_limit_is_refused():
+    client = TestClient(server.app)
+    response = client.post("/answer-keys", content=b"x" * (server.MAX_REQUEST_BYTES + 1), headers=MULTIPART)
+    assert response.status_code == 413
+
+
+def test_limits_are_per_route():
+    assert server.MAX_REQUEST_BYTES < server.MAX_BATCH_REQUEST_BYTES
+    client = TestClient(server.app)
+    # Over the single-paper limit but within the batch limit: rejected by
+    # the form parser, not by the size limit
+    response = client.post("/batch-jobs", content=chunked(server.MAX_REQUEST_BYTES + 1), headers=MULTIPART)
+    assert response.status_code != 413
+    response = client.post("/analytics", content=chunked(server.MAX_JSON_REQUEST_BYTES + 1),
+                           headers={"content-type": "application/json"})
+    assert response.status_code == 413
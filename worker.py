@@ -0,0 +1,46 @@
+"""Standalone batch grading worker.
+
+Grades papers queued through POST /batch-jobs from the shared job store
+(EVALO_DATA_PATH, with the PDFs under EVALO_JOBS_DIR). Start as many as
+the Groq rate limits allow; set EVALO_EMBEDDED_WORKER=0 on the API if
+it should not grade papers itself.
+
+    python worker.py --concurrency 8
+"""
+
+import argparse
+import asyncio
+import signal
+
+import server
+
+
+async def run(concurrency: int):
+    worker = server.JobWorker(server.job_store, concurrency)
+    task = asyncio.create_task(worker.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    print(f"Worker {worker.worker_id} grading up to {worker.concurrency} papers at a time")
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.close_shared_resources()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade queued batch job papers.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=server.BATCH_WORKERS,
+        help="papers graded at the same time (default: EVALO_BATCH_WORKERS)",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()